@@ -8,6 +8,7 @@ from adafruit_hid.mouse import Mouse
 import bongo
 
 import hardware
+import inputs
 import joystick
 
 class MacroPad:
@@ -20,6 +21,7 @@ class MacroPad:
         self.keyboard_layout = KeyboardLayoutUS(self.keyboard)
 
         self.mouse = Mouse(usb_hid.devices)
+        self.motion = joystick.MouseMotion(self.mouse)
 
         # Bongo cat!
         self.bongo_cat = bongo.Bongo()
@@ -28,37 +30,43 @@ class MacroPad:
 
     def enter(self):
         hardware.display.show(self.bongo_cat.group)
+        inputs.use_joystick(True)
 
     def exit(self):
-        pass  # nothing to do
+        inputs.use_joystick(False)
+        self.motion.set_position(0, 0)
 
-    def handle_joystick(self, joy_xy):
-        (x, y) = joystick.get_mouse_move(joy_xy)
-        if x != 0 or y != 0:
-            self.mouse.move(x, y)
+    def handle_event(self, event):
+        if event.kind == inputs.JOYSTICK:
+            self.motion.set_position(event.x, event.y)
+        elif event.kind == inputs.CLICK and event.key == hardware.KEY_JOY and event.value == 2:
+            self.motion.set_scroll(not self.motion.scroll)
+            print("joystick scrolls" if self.motion.scroll else "joystick moves the mouse")
+        elif event.kind == inputs.CLICK and event.value == 1:
+            if event.key == hardware.KEY_FS1:
+                self.keyboard.press(Keycode.PAGE_UP)
+                self.keyboard.release_all()
+            elif event.key == hardware.KEY_FS2:
+                self.keyboard.press(Keycode.PAGE_DOWN)
+                self.keyboard.release_all()
+            elif event.key == hardware.KEY_BTN:
+                print("red button pressed")
+                self.bongo_cat.update(keypad.Event(1, True))
+            elif event.key == hardware.KEY_JOY:
+                print("joy button pressed")
+                self.mouse.click(Mouse.LEFT_BUTTON)
+        elif event.kind == inputs.LONG:
+            if event.key == hardware.KEY_FS1:
+                self.keyboard.press(Keycode.HOME)
+                self.keyboard.release_all()
+            elif event.key == hardware.KEY_FS2:
+                self.keyboard.press(Keycode.END)
+                self.keyboard.release_all()
+            elif event.key == hardware.KEY_JOY:
+                print("joy button long pressed")
+                self.mouse.click(Mouse.RIGHT_BUTTON)
 
     def loop_handler(self):
-
-        if hardware.clicked(hardware.KEY_FS1):
-            self.keyboard.press(Keycode.PAGE_UP)
-            self.keyboard.release_all()
-        elif hardware.clicked(hardware.KEY_FS2):
-            self.keyboard.press(Keycode.PAGE_DOWN)
-            self.keyboard.release_all()
-        elif hardware.long_clicked(hardware.KEY_FS1):
-            self.keyboard.press(Keycode.HOME)
-            self.keyboard.release_all()
-        elif hardware.long_clicked(hardware.KEY_FS2):
-            self.keyboard.press(Keycode.END)
-            self.keyboard.release_all()
-        elif hardware.clicked(hardware.KEY_BTN):
-            print("red button pressed")
-            self.bongo_cat.update(keypad.Event(1, True))
-        elif hardware.clicked(hardware.KEY_JOY):
-            print("joy button pressed")
-            self.mouse.click(Mouse.LEFT_BUTTON)
-        elif hardware.long_clicked(hardware.KEY_JOY):
-            print("joy button long pressed")
-            self.mouse.click(Mouse.RIGHT_BUTTON)
+        self.motion.update()
 
         #time.sleep(0.1)
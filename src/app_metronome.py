@@ -1,207 +1,62 @@
-from adafruit_ticks import ticks_ms, ticks_diff
+import time
 import neopixel
+from neopixel_write import neopixel_write
 import displayio
 import terminalio
 from adafruit_display_text import label
 import audiocore
-import audiobusio
-import audiomixer
+import ulab.numpy as np
 
 import hardware
+import inputs
+import patterns
+import scheduler
 
 class Metronome:
+    # Whole bars are rendered into one looping sample, so the clicks are timed by the audio clock.
+    # The bar buffer is as big as free RAM allows, up to MAX_BAR_SAMPLES (128KB, about 3 s).
+    # Bars that don't fit fall back to clicks timed by the scheduler.
+    SAMPLE_RATE = hardware.SND_RATE
+    CLICK_STRONG = "files/Ping Hi.wav"
+    CLICK_WEAK = "files/Ping Low.wav"
+    MAX_BAR_SAMPLES = 65536
+    MIN_BAR_SAMPLES = 8192
+
     def __init__(self, title):
         self.title = title
 
-        # Patterns
-        # sounds: x = strong, 0 = weak, . = silence
-        self.beat_patterns = [
-            {
-                "name": "4/4",
-                "beats": 4,
-                "tempo_x": 1,
-                "subbeats": 1,
-                "sounds": "x000",
-                "leds": [
-                    "222000000000",
-                    "000111000000",
-                    "000000111000",
-                    "000000000111"
-                ]
-            },
-            {
-                "name": "3/4",
-                "beats": 3,
-                "tempo_x": 1,
-                "subbeats": 1,
-                "sounds": "x00",
-                "leds": [
-                    "222200000000",
-                    "000011110000",
-                    "000000001111"
-                ]
-            },
-            {
-                "name": "2/4",
-                "beats": 2,
-                "tempo_x": 1,
-                "subbeats": 1,
-                "sounds": "x0",
-                "leds": [
-                    "222222000000",
-                    "000000111111",
-                ]
-            },
-            {
-                "name": "6/8 (3+3)",
-                "beats": 6,
-                "tempo_x": 3,
-                "subbeats": 1,
-                "sounds": "x00x00",
-                "leds": [
-                    "220000000000",
-                    "001100000000",
-                    "000011000000",
-                    "000000220000",
-                    "000000001100",
-                    "000000000011",
-                ]
-            },
-            {
-                "name": "Solea",
-                "beats": 12,
-                "tempo_x": 1,
-                "subbeats": 2,
-                "sounds": "-00-x--00-x-0-x-00x-0-x-",
-                "leds": [
-                    "010000000000",
-                    "001000000000",
-                    "000200000000",
-                    "000010000000",
-                    "000001000000",
-                    "000000200000",
-                    "000000010000",
-                    "000000002000",
-                    "000000000100",
-                    "000000000020",
-                    "000000000001",
-                    "200000000000"
-                ],
-            },
-            {
-                "name": "Alegria",
-                "beats": 12,
-                "tempo_x": 1,
-                "subbeats": 2,
-                "sounds": "-00-x--00-x--0x--0x--0x-",
-                "leds": [
-                    "010000000000",
-                    "001000000000",
-                    "000200000000",
-                    "000010000000",
-                    "000001000000",
-                    "000000200000",
-                    "000000010000",
-                    "000000002000",
-                    "000000000100",
-                    "000000000020",
-                    "000000000001",
-                    "200000000000"
-                ]
-            },
-            {
-                "name": "Buleria",
-                "beats": 12,
-                "tempo_x": 1,
-                "subbeats": 2,
-                "sounds": "000-x-000-x-00x-00x-0-x-",
-                "leds": [
-                    "010000000000",
-                    "001000000000",
-                    "000200000000",
-                    "000010000000",
-                    "000001000000",
-                    "000000200000",
-                    "000000010000",
-                    "000000002000",
-                    "000000000100",
-                    "000000000020",
-                    "000000000001",
-                    "200000000000"
-                ]
-            },
-            {
-                "name": "Siguiriyas",
-                "beats": 12,
-                "tempo_x": 1,
-                "subbeats": 2,
-                "sounds": "x--0x--0x--00-x-0-0-x-0-",
-                "leds": [
-                    "000000002000",
-                    "000000000100",
-                    "000000000020",
-                    "000000000001",
-                    "200000000000",
-                    "010000000000",
-                    "001000000000",
-                    "000200000000",
-                    "000010000000",
-                    "000001000000",
-                    "000000200000",
-                    "000000010000"
-                ]
-            },
-            {
-                "name": "Tangos",
-                "beats": 4,
-                "tempo_x": 1,
-                "subbeats": 2,
-                "sounds": "--00x-0-",
-                "leds": [
-                    "222000000000",
-                    "000111000000",
-                    "000000222000",
-                    "000000000111"
-                ]
-            },
-            {
-                "name": "Rhumba",
-                "beats": 4,
-                "tempo_x": 1,
-                "subbeats": 2,
-                "sounds": "0-x-0-x-",
-                "leds": [
-                    "111000000000",
-                    "000222000000",
-                    "000000111000",
-                    "000000000222"
-                ]
-            }
-
-
-        ]
-
-        self.curr_pattern = 0
-        self._set_tempo(60)
-        self.time_signature = self.beat_patterns[self.curr_pattern]["beats"]
-        self.BEEP_DURATION = 0.05
-        self.t0 = ticks_ms()
-        self.step = 0
-        self.beat = 0
+        # Patterns, see patterns.py for the file format
+        self.patterns = patterns.PatternLibrary("files/patterns.jsonl", led_offset=3)
 
         # LEDs
-        self.leds = neopixel.NeoPixel(hardware.LED_RING, 12, brightness=0.1, auto_write=False)
+        # Frames are pre-rendered to raw pixel data and written straight to the strip, see load_pattern()
+        self.leds = neopixel.NeoPixel(hardware.LED_RING, patterns.LED_COUNT, brightness=0.1, auto_write=False)
         self.led_colors = [
             (0, 0, 0),      # no color
             (0, 255, 0),    # beat
             (255, 0, 0),    # accent1
             (255, 165, 0)   # accent2
         ]
+        # one pixel of each colour, with the brightness and byte order applied
+        order = ["RGBW".index(c) for c in self.leds.byteorder]
+        self.led_pixels = [bytes(int(color[i] * self.leds.brightness) if i < 3 else 0 for i in order)
+                           for color in self.led_colors]
+        self.led_blank = self.led_pixels[0] * len(self.leds)
+
+        self.load_pattern(0)
+        self.scheduler = scheduler.Scheduler()
+        self.jitter = scheduler.JitterLog()  # joystick button prints a report
+        self._set_tempo(60)
+        self.BEEP_DURATION = 0.05
+        self.step = 0
+        self.beat = 0
+        self.bar_len = 0  # samples in the rendered bar, 0 when clicks are being scheduled instead
+        self.bar_buffer = None
 
         # Display
         self.beat_text = "-"
 
-        self.label_pattern = label.Label(terminalio.FONT, scale=1, text=self.beat_patterns[self.curr_pattern]["name"], color=0xFFFFFF, anchor_point=(0.5,0), x=8, y=16+10)
+        self.label_pattern = label.Label(terminalio.FONT, scale=1, text=self.pattern.name, color=0xFFFFFF, anchor_point=(0.5,0), x=8, y=16+10)
         self.label_bpm = label.Label(terminalio.FONT, scale=2, text=str(self.tempo) + " BPM", color=0xFFFFFF, anchor_point=(0.5,0), x=42, y=16+24)
         self.label_beats = label.Label(terminalio.FONT, scale=1, text=self.beat_text, color=0xFFFFFF, anchor_point=(0.5,0), x=8, y=16+42)
 
@@ -213,103 +68,224 @@ class Metronome:
 
 
     def play(self):  # Play metronome sound and flash display
-        # only the first sound array for now
-        rhythm = self.beat_patterns[self.curr_pattern]["sounds"]
-        sound = rhythm[self.step]
-        if sound == "x":  # Put emphasis on downbeat
-            self.curr_voice = (self.curr_voice + 1) % self.num_voices
-            self.mixer.voice[self.curr_voice].play(self.sample_x, loop=False)
-        elif sound == "0":
-            self.curr_voice = (self.curr_voice + 1) % self.num_voices
-            self.mixer.voice[self.curr_voice].play(self.sample_0, loop=False)
-
-                # update display and leds if on beat
-        if self._is_on_beat():
+        sound = self.pattern.sounds[self.step]
+        if sound != patterns.SILENT:
+            self.curr_voice = self.curr_voice % (len(self.voices) - 1) + 1
+            hardware.audio.play(self.voices[self.curr_voice], self.samples[sound])
+
+        # update display and leds if on beat
+        if self.pattern.on_beat[self.step]:
             self.update_display()
             self.update_leds()
 
+    def load_pattern(self, index):
+        """
+        Read and compile a pattern, and pre-render its LED frames.
+        """
+        self.curr_pattern = index
+        self.pattern = self.patterns.load(index)
+        self.led_frames = self.pattern.led_frames(self.led_pixels)
+
     def enter(self):
         hardware.display.show(self.screen)
 
-        # Speaker
-        self.speaker = audiobusio.I2SOut(hardware.SND_BCLK, hardware.SND_LRC, hardware.SND_DIN)
-        # connect speaker to AudioMixer
-        self.num_voices = 2
+        # Speaker. Voice 0 plays rendered bars, the others single clicks.
+        self.voices = hardware.audio.attach(3)
         self.curr_voice = 0
-        # sufficient buffer_size needed to prevent glitches. too high and timing will be off.
-        self.mixer = audiomixer.Mixer(voice_count=self.num_voices, buffer_size=4096, sample_rate=22050,
-                        channel_count=1, bits_per_sample=16, samples_signed=True)
-        self.speaker.play(self.mixer)
-        self.mixer.voice[0].level = 1.0
-        self.mixer.voice[1].level = 1.0
-        self.sample_x = audiocore.WaveFile(open("files/Ping Hi.wav","rb"))
-        self.sample_0 = audiocore.WaveFile(open("files/Ping Low.wav","rb"))
+        self.clicks = {patterns.STRONG: hardware.audio.clip(self.CLICK_STRONG),
+                       patterns.WEAK: hardware.audio.clip(self.CLICK_WEAK)}
+        self.samples = {patterns.STRONG: hardware.audio.sample(self.CLICK_STRONG),
+                        patterns.WEAK: hardware.audio.sample(self.CLICK_WEAK)}
+
+        self.bar_buffer = None
+        size = self.MAX_BAR_SAMPLES
+        while self.bar_buffer is None and size >= self.MIN_BAR_SAMPLES:
+            try:
+                self.bar_buffer = np.zeros(size, dtype=np.int16)  # allocated in place, no temporary copy
+            except MemoryError:
+                size //= 2
+        if self.bar_buffer is None:
+            print("No room for bar rendering, scheduling clicks instead")
+        self.restart()
+
+    def render_bar(self, offset=0):
+        """
+        Render one bar of the current pattern at the current tempo into bar_buffer.
+
+        :param offset: sample of the bar to start the buffer from, to carry on from part way through it
+        :return: length of the bar in samples, or 0 if it doesn't fit
+        :rtype: int
+        """
+        steps = self.pattern.steps
+        bar_len = self._bar_samples()
+        if self.bar_buffer is None or bar_len > len(self.bar_buffer):
+            return 0
+        offset %= bar_len
+
+        bar = self.bar_buffer
+        bar[:bar_len] = 0
+        for k in range(steps):
+            click = self.clicks.get(self.pattern.sounds[k])
+            if click is None:
+                continue
+            # step starts are worked out from the bar length so rounding doesn't add up across the bar
+            start = k * bar_len // steps
+            n = min(len(click), (k + 1) * bar_len // steps - start)
+            src = np.frombuffer(click, dtype=np.int16)
+            # a click can run off the end of the buffer when it starts part way through the bar
+            start = (start - offset) % bar_len
+            first = min(n, bar_len - start)
+            bar[start:start + first] = src[:first]
+            if first < n:
+                bar[:n - first] = src[first:n]
+        return bar_len
+
+    def restart(self):
+        """
+        Start the current pattern from the top of the bar, looping a rendered bar if it fits.
+        """
+        hardware.audio.stop(self.voices[0])
+        self.step = 0
+        self.beat = 0
+        self.jitter.reset()
+        self.bar_len = self.render_bar()
+        if self.bar_len:
+            self._play_bar()
+            self.step = -1  # so the first step gets shown
+        else:
+            self.scheduler.start()
+
+    def retempo(self):
+        """
+        Carry on at the new tempo from the same point in the bar.
+
+        In scheduled mode _set_tempo has already moved the scheduler over. A looping bar is re-rendered to start
+        from where playback has got to, so the pattern doesn't jump back to the downbeat.
+        """
+        if not self.bar_len:
+            return
+        pos = self._bar_pos(heard=False)
+        old_len = self.bar_len
+        hardware.audio.stop(self.voices[0])
+        # same fraction of the way through the bar at the new length
+        offset = pos * self._bar_samples() // old_len
+        self.bar_len = self.render_bar(offset)
+        if self.bar_len:
+            self._play_bar(offset)
+            return
+
+        # doesn't fit any more. The mixer has the old bar up to pos already, so schedule the clicks from the next
+        # step after it, due when it would have been in the old bar.
+        steps = self.pattern.steps
+        step = pos * steps // old_len + 1
+        delay = (step * old_len // steps - pos) * 1000 // self.SAMPLE_RATE
+        self.step = step % steps
+        self.beat = self.pattern.beat[self.step]
+        self.scheduler.start(delay)
+
+    def _bar_samples(self):
+        return self.pattern.steps * 60 * self.SAMPLE_RATE // self.pattern.steps_per_minute(self.tempo)
+
+    def _bar_pos(self, heard=True):
+        # sample of the looping bar being heard now, or -1 before the first one comes out of the DAC.
+        # With heard=False, the sample the mixer is reading now, which is heard one latency later.
+        elapsed = time.monotonic_ns() - self.t_play
+        if heard:
+            elapsed -= hardware.audio.latency_ns
+        if elapsed < 0:
+            return -1
+        return elapsed * self.SAMPLE_RATE // 1000000000 % self.bar_len
+
+    def _play_bar(self, offset=0):
+        self.bar_sample = audiocore.RawSample(self.bar_buffer[:self.bar_len], sample_rate=self.SAMPLE_RATE)
+        hardware.audio.play(self.voices[0], self.bar_sample, loop=True)
+        # when the buffer's first sample, offset into the bar, started playing
+        self.t_play = time.monotonic_ns() - offset * 1000000000 // self.SAMPLE_RATE
+
+    def follow_bar(self):
+        """
+        Update the display and LEDs from the position in the looping bar.
+
+        The position is worked out from the time since playback started, less the audio latency, and the rendered
+        bar length.
+        """
+        pos = self._bar_pos()
+        if pos < 0:
+            return
+        step = pos * self.pattern.steps // self.bar_len
+        if step == self.step:
+            return
+        self.step = step
+        # the clicks themselves are sample-accurate, this is how far the display and LEDs lag behind them
+        self.jitter.record((pos - step * self.bar_len // self.pattern.steps) * 1000 // self.SAMPLE_RATE)
+        if self.pattern.on_beat[step]:
+            self.beat = self.pattern.beat[step]
+            self.update_display()
+            self.update_leds()
 
 
     def exit(self):
         # clear all LEDs
-        for i in range(len(self.leds)):
-            self.leds[i] = (0,0,0)
-        self.leds.show()
-        self.speaker.deinit()
+        neopixel_write(self.leds.pin, self.led_blank)
+        hardware.audio.detach(self.voices)
+        # give the RAM back to the other apps
+        self.bar_sample = None
+        self.bar_buffer = None
 
     def update_leds(self):
-        offset = 3
-        led_pattern = self.beat_patterns[self.curr_pattern]["leds"]
-        for i in range(len(self.leds)):
-            pos = (offset + i) % len(self.leds)
-            self.leds[pos] = self.led_colors[int(led_pattern[self.beat][i])]
+        neopixel_write(self.leds.pin, self.led_frames[self.beat])
 
-        self.leds.show()
+    def handle_event(self, event):
+        if event.kind == inputs.CLICK and event.value == 1:
+            if event.key == hardware.KEY_BTN:
+                print("Metronome button pressed")
+                self.load_pattern((self.curr_pattern + 1) % len(self.patterns))
+                self._set_tempo(self.tempo)
+                self.restart()
+            elif event.key == hardware.KEY_JOY:
+                self.jitter.report(f"{self.tempo} BPM {'bar loop' if self.bar_len else 'scheduled'}")
+        elif event.kind == inputs.ENCODER:
+            if event.value > 0:
+                self._set_tempo(min(self.tempo + 10, 400))
+            else:
+                self._set_tempo(max(self.tempo - 10, 20))
 
-    def handle_joystick(self, joy_xy):
-        pass # nothing to do
+            self.retempo()
+            self.update_display()
 
     def _set_tempo(self, tempo):
         self.tempo = tempo
-        self.delay = 60 / (self.tempo * self.beat_patterns[self.curr_pattern]["tempo_x"])
+        self.scheduler.set_rate(self.pattern.steps_per_minute(self.tempo))
 
-    def _is_on_beat(self):
-        return self.step % self.beat_patterns[self.curr_pattern]["subbeats"] == 0
+    def _advance(self):
+        self.step = (self.step + 1) % self.pattern.steps
+        self.beat = self.pattern.beat[self.step]
 
     def loop_handler(self):
         # check time
-        if ticks_diff(ticks_ms(), self.t0) >= 1000 * self.delay / self.beat_patterns[self.curr_pattern]["subbeats"]:
-            self.t0 = ticks_ms()  # reset time before click to maintain accuracy
-            #print(self.step, self.beat, self._is_on_beat())
+        if self.bar_len:
+            self.follow_bar()
+            steps = 0
+        else:
+            steps = self.scheduler.poll()
+        if steps:
+            self.jitter.record(self.scheduler.late, self.scheduler.drift())
+            # if the loop was held up past whole steps, skip them silently so the bar stays in time
+            for _ in range(steps - 1):
+                self._advance()
+            #print(self.step, self.beat, self.pattern.on_beat[self.step])
             self.play()
-
-            # increment
-            self.step = (self.step + 1) % (self.beat_patterns[self.curr_pattern]["beats"] * self.beat_patterns[self.curr_pattern]["subbeats"])
-            if self._is_on_beat():
-                self.beat = (self.beat + 1) % self.time_signature
-
-        if hardware.clicked(hardware.KEY_BTN):
-            print("Metronome button pressed")
-            self.curr_pattern = (self.curr_pattern + 1) % len(self.beat_patterns)
-            self.time_signature = self.beat_patterns[self.curr_pattern]["beats"]
-            self._set_tempo(self.tempo)
-            self.step = 0
-            self.beat = 0
-
-        pos_change = hardware.encoder_get_change()
-        if pos_change != 0:
-            if pos_change > 0:
-                self._set_tempo(min(self.tempo + 10, 400))
-            else:
-                self._set_tempo(max(self.tempo - 10, 20))
-
-            self.update_display()
+            self._advance()
 
     def update_display(self):
         self.beat_text = ""
-        for i in range(self.beat_patterns[self.curr_pattern]["beats"]):
+        for i in range(self.pattern.beats):
             if (i == self.beat):
                 self.beat_text += "*"
             else:
                 self.beat_text += "-"
 
-        self.label_pattern.text = self.beat_patterns[self.curr_pattern]["name"]
+        self.label_pattern.text = self.pattern.name
         self.label_bpm.text = str(self.tempo) + " BPM"
         self.label_beats.text = self.beat_text
         hardware.display.show(self.screen)
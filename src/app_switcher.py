@@ -7,7 +7,7 @@ import app_tuner
 import app_visualizer
 import app_synth
 
-import joystick
+import inputs
 
 MODE_NORMAL = 0
 MODE_SWITCHING = 1
@@ -27,50 +27,35 @@ class ModeSwitcher:
             app_visualizer.Visualizer("VISUALIZER")
             ]
 
+        self.event = inputs.InputEvent()
         self.apps[self.curr_app].enter()
 
     def loop_handler(self):
-        # update all buttons
-        for i in hardware.keys.keys():
-            hardware.keys[i].update()
-
-        """
-        for i in hardware.keys.keys():
-            if hardware.keys[i].long_press:
-                print(hardware.KEYS_MAP[i]["name"], " long pressed")
-            if hardware.keys[i].short_count != 0:
-                print(hardware.KEYS_MAP[i]["name"], " short pressed", hardware.keys[i].short_count, "times")
-            if hardware.keys[i].long_press and hardware.keys[i].short_count == 1:
-                print(hardware.KEYS_MAP[i]["name"], " double long pressed")
-            #if hardware.keys[i].pressed:
-            #    print(hardware.KEYS_MAP[i]["name"], " pressed")
-        """
-
-        # button actions
-        if hardware.clicked(hardware.KEY_ENC):
-            if self.curr_mode == MODE_NORMAL:
-                self.curr_mode = MODE_SWITCHING
-                self.apps[self.curr_app].exit()
-                disp_utils.display.print("Switching", self.apps[self.curr_app].title)
-            else:
-                self.curr_mode = MODE_NORMAL
-                self.apps[self.curr_app].enter()
-            print("Button pressed. Mode is now " + str(self.curr_mode))
-
-        # joystick
-        joy_xy = joystick.read_joystick()
-        self.apps[self.curr_app].handle_joystick(joy_xy)
-
-        if self.curr_mode == MODE_NORMAL:
-            self.apps[self.curr_app].loop_handler()
-        else:
-            pos_change = hardware.encoder_get_change()
-            if pos_change != 0:
-                if pos_change > 0:
+        inputs.update()
+
+        event = self.event
+        while inputs.queue.get_into(event):
+            #print(event)
+            if event.kind == inputs.CLICK and event.key == hardware.KEY_ENC and event.value == 1:
+                if self.curr_mode == MODE_NORMAL:
+                    self.curr_mode = MODE_SWITCHING
+                    self.apps[self.curr_app].exit()
+                    disp_utils.display.print("Switching", self.apps[self.curr_app].title)
+                else:
+                    self.curr_mode = MODE_NORMAL
+                    self.apps[self.curr_app].enter()
+                print("Button pressed. Mode is now " + str(self.curr_mode))
+            elif self.curr_mode == MODE_NORMAL:
+                self.apps[self.curr_app].handle_event(event)
+            elif event.kind == inputs.ENCODER:
+                if event.value > 0:
                     self.next_app()
                 else:
                     self.prev_app()
 
+        if self.curr_mode == MODE_NORMAL:
+            self.apps[self.curr_app].loop_handler()
+
 
     def next_app(self):
         self.curr_app = (self.curr_app + 1) % len(self.apps)
@@ -1,5 +1,5 @@
 import hardware
-import audiobusio
+import inputs
 import synthio
 
 class Synthesizer:
@@ -8,20 +8,20 @@ class Synthesizer:
 
         self.melody = synthio.MidiTrack(b"\0\x90H\0*\x80H\0\6\x90J\0*\x80J\0\6\x90L\0*\x80L\0\6\x90J\0" +
                         b"*\x80J\0\6\x90H\0*\x80H\0\6\x90J\0*\x80J\0\6\x90L\0T\x80L\0" +
-                        b"\x0c\x90H\0T\x80H\0\x0c\x90H\0T\x80H\0", tempo=640)
+                        b"\x0c\x90H\0T\x80H\0\x0c\x90H\0T\x80H\0", tempo=640,
+                        sample_rate=hardware.SND_RATE)
 
 
     def enter(self):
-        self.speaker = audiobusio.I2SOut(hardware.SND_BCLK, hardware.SND_LRC, hardware.SND_DIN)
+        self.voices = hardware.audio.attach(1)
 
     def exit(self):
-        self.speaker.deinit()
+        hardware.audio.detach(self.voices)
 
-    def handle_joystick(self, joy_xy):
-        pass
+    def handle_event(self, event):
+        if event.kind == inputs.CLICK and event.key == hardware.KEY_BTN and event.value == 1:
+            print("red button pressed")
+            hardware.audio.play(self.voices[0], self.melody)
 
     def loop_handler(self):
-
-        if hardware.clicked(hardware.KEY_BTN):
-            print("red button pressed")
-            self.speaker.play(self.melody)
+        pass
@@ -1,48 +1,49 @@
-import array
 import time
-import math
 import ulab.numpy as np
 import displayio
 import terminalio
 from adafruit_display_text import label
-from adafruit_display_shapes.sparkline import Sparkline
 
 import hardware
+import disp_utils
+import inputs
 
 import yin
+import notes
 
-# I could also just generate this list programmatically
-NOTE_PITCHES = (
-    ("C2", 65.47), ("C#2/Cb2", 69.30), ("D2", 73.42), ("D#2/Eb2", 77.78), ("E2", 82.41), ("F2", 87.31),
-    ("F#2/Gb2", 92.50), ("G2", 98.00), ("G#2/Ab2", 103.83), ("A2", 110.00), ("A#2/Bb2", 116.54), ("B2", 123.47),
-
-    ("C3", 130.81), ("C#3/Cb3", 138.59), ("D3", 146.83), ("D#3/Eb3", 155.56), ("E3", 164.81), ("F3", 174.61),
-    ("F#3/Gb3", 185.00), ("G3", 196.00), ("G#3/Ab3", 207.65), ("A3", 220.00), ("A#3/Bb3", 233.08), ("B3", 246.94),
-
-    ("C4", 261.63), ("C#4/Cb", 277.18), ("D4", 293.66), ("D#4/Eb4", 311.13), ("E4", 329.63), ("F4", 349.23),
-    ("F#4/Gb4", 369.99), ("G4", 392.00), ("G#4/Ab4", 415.30), ("A4", 440.00), ("A#4/Bb4", 466.16), ("B4", 493.88),
-
-    ("C5", 523.25), ("C#5/Cb5", 554.37), ("D5", 587.33), ("D#5/Eb5", 622.25), ("E5", 659.25), ("F5", 698.46),
-    ("F#5/Gb5", 739.99), ("G5", 783.99), ("G#5/Ab5", 830.61), ("A5", 880.00), ("A#5/Bb5", 932.33), ("B5", 987.77),
-)
 
 class Tuner:
+    CALIBRATION_FRAMES = 30
+
     def __init__(self, title):
         self.title = title
 
-        self.length = 512
-        self.samples = array.array("H", [0x0000] * self.length)
-        self.rate = 8000
+        # capture one hop at a time, YIN runs on the last w_len samples.
+        # With sub-sample interpolation 5 kHz is enough, and a 160 sample window (32 ms) fits a 256 point FFT.
+        self.length = 80
+        self.raw = ()  # views of the capture buffers, set up on entering
+        self.block = None
+        self.rate = 5000
+        self.yin_plan = yin.YinPlan(self.rate, w_len=160, f0_min=60, f0_max=900, harmo_thresh=0.4)
+        # while a note is held, only search the lags around its period. Red button toggles this.
+        self.tracker = yin.YinTracker(self.yin_plan, hop=self.length, tracking=True)
+        # YIN is skipped while the gate is closed. It calibrates to the room on entering, long press red button to redo.
+        self.gate = yin.NoiseGate()
+        self.calibration_frames = 0
+
+        # turn the knob to change the A4 reference, double click red button to change temperament
+        self.notes = notes.NoteFinder(a4=440)
 
         # Display
         self.rms = 0.00
         self.detected_note = "??"
-        self.pitch_diff = 0.00
+        self.pitch_diff = 0.00  # cents
         self.last_detected_time = 0
 
         self.label_note = label.Label(terminalio.FONT, scale=2, text=self.detected_note, color=0xFFFFFF, anchor_point=(0.5,0), x=8, y=16+10)
         self.label_pitch_diff = label.Label(terminalio.FONT, scale=1, text=str(self.pitch_diff), color=0xFFFFFF, anchor_point=(0.5,0), x=96, y=16+10)
-        self.spark = Sparkline(width=128, height=16, max_items=128, y_min=0, y_max=33, x=0, y=48)
+        self.label_ref = label.Label(terminalio.FONT, scale=1, text="A" + str(self.notes.a4), color=0xFFFFFF, anchor_point=(0.5,0), x=96, y=16+22)
+        self.wave = disp_utils.Waveform(128, 16, -hardware.MIC_MIDPOINT, hardware.MIC_MIDPOINT, x=0, y=48)
 
 
         self.screen = displayio.Group()
@@ -50,58 +51,94 @@ class Tuner:
         #self.screen.append(label.Label(terminalio.FONT, text=f'{self.rms:>10}', color=0xFFFFFF, x=8, y=16+1*10))
         self.screen.append(self.label_note)
         self.screen.append(self.label_pitch_diff)
-        self.screen.append(self.spark)
+        self.screen.append(self.label_ref)
+        self.screen.append(self.wave.grid)
 
     def enter(self):
         hardware.display.show(self.screen)
+        hardware.mic.start(self.length, self.rate)
+        if not hardware.mic.looping:
+            # every blocking read starts after a gap, so capture a whole window each time
+            hardware.mic.start(self.yin_plan.w_len, self.rate)
+        self.raw = [np.frombuffer(half, dtype=np.uint16) for half in hardware.mic.halves]  # no copy
+        if self.block is None or len(self.block) != len(self.raw[0]):
+            self.block = np.zeros(len(self.raw[0]), dtype=np.int16)
+        self.tracker.reset()  # the window still holds audio from the last time the tuner was on
+        self.start_calibration()
+
+    def start_calibration(self):
+        print("Calibrating noise gate, keep quiet")
+        self.gate.start_calibration()
+        self.calibration_frames = self.CALIBRATION_FRAMES
 
     def exit(self):
-        pass  # nothing to do
-
-    def handle_joystick(self, joy_xy):
-        pass # nothing to do
-
-    def handle_key_event(self, event):
-        print("App currently doesn't handle any keys")
+        hardware.mic.stop()
+
+    def handle_event(self, event):
+        if event.kind == inputs.CLICK and event.key == hardware.KEY_BTN:
+            if event.value == 1:
+                self.tracker.tracking = not self.tracker.tracking
+                print("Pitch tracking", "on" if self.tracker.tracking else "off")
+            elif event.value == 2:
+                names = list(notes.TEMPERAMENTS.keys())
+                self.notes.set_temperament(names[(names.index(self.notes.temperament) + 1) % len(names)])
+                print("Temperament", self.notes.temperament)
+        elif event.kind == inputs.LONG and event.key == hardware.KEY_BTN:
+            self.start_calibration()
+        elif event.kind == inputs.ENCODER:
+            a4 = min(max(self.notes.a4 + (1 if event.value > 0 else -1), 400), 480)
+            self.notes.set_reference(a4)
+            self.label_ref.text = "A" + str(a4)
 
     def loop_handler(self):
-        hardware.mic_readinto(self.samples, self.rate)
+        half = hardware.mic.read()
+        while hardware.mic.skipped:
+            # this block doesn't follow on from the last one, so start the window over from it
+            self.tracker.reset()
+            if not hardware.mic.looping:
+                break  # blocking reads capture a whole window each time
+            # the next block follows straight on if it's read right away, so wait for it to fill the window
+            self.tracker.push(hardware.mic_to_int16(self.raw[half], self.block), analyse=False)
+            half = hardware.mic.read()
+        x = hardware.mic_to_int16(self.raw[half], self.block)
+        if self.calibration_frames > 0:
+            self.gate.calibrate(x)
+            self.calibration_frames -= 1
+            if self.calibration_frames == 0:
+                print("Noise gate threshold", self.gate.threshold)
+            gate_open = False
+        else:
+            gate_open = self.gate.update(x)
 
-        x = np.array([(x - 32767)/65536 for x in self.samples])
         #start = time.monotonic()
-        pitches, harmonic_rates, argmins, times = yin.compute_yin(sig=x, sr=self.rate, w_len=256, w_step=256, f0_min=60, f0_max=900, harmo_thresh=0.4)
+        self.tracker.push(x, analyse=gate_open)
+        pitch = self.tracker.pitch
+        harmonic_rate = self.tracker.harmonic_rate
         #end = time.monotonic()
         #print("took ", end-start)
-        #print(pitches, harmonic_rates)
+        #print(pitch, harmonic_rate)
 
         if time.monotonic() - self.last_detected_time > 3.0:
             self.detected_note = "??"
             self.pitch_diff = 0.00
 
-        if pitches[0] != 0.0 and harmonic_rates[0] > 0.2:
-            matches = [abs(pitches[0] - x[1]) for x in NOTE_PITCHES]
-            idx = matches.index(min(matches))
-            self.pitch_diff = pitches[0] - NOTE_PITCHES[idx][1]
-            self.detected_note = NOTE_PITCHES[idx][0]
+        if pitch != 0.0 and harmonic_rate > 0.2:
+            name, octave, self.pitch_diff = self.notes.find(pitch)
+            self.detected_note = name + str(octave)
             self.last_detected_time = time.monotonic()
-            print(self.detected_note, ":", NOTE_PITCHES[idx][1], pitches[0], self.pitch_diff)
+            print(self.detected_note, ":", pitch, self.pitch_diff)
 
         self.update_display()
         #time.sleep(0.1)
 
     def update_display(self):
-        values = np.array(self.samples)
-        minbuf = np.mean(values)
-        values = values - minbuf
-        samples_sum = np.sum(values * values)
-        self.rms = math.sqrt(samples_sum / len(values))
-
-        step = self.length // 128
-        for i in range(0, self.length, step):
-            self.spark.add_value(self.samples[i]//2000, False)
-
-        self.spark.update()
-        self.label_note.text = self.detected_note
-        self.label_pitch_diff.text = f'{self.pitch_diff:.3f}'
-        hardware.display.show(self.screen)
-
+        self.rms = self.gate.level
+        # show the analysis window rather than just the last hop
+        self.wave.update(self.tracker.window)
+
+        # setting a label's text re-lays it out, so only do it when it changes
+        diff_text = f'{self.pitch_diff:+.1f}c'
+        if self.label_note.text != self.detected_note:
+            self.label_note.text = self.detected_note
+        if self.label_pitch_diff.text != diff_text:
+            self.label_pitch_diff.text = diff_text
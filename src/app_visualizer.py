@@ -2,26 +2,94 @@
 
 # CircuitPython Music Visualizer
 # Aoyama_PROD, STEAM Tokyo
-import array
+import math
+import time
 import displayio
+import terminalio
+import bitmaptools
 import adafruit_imageload
+from adafruit_display_text import label
 import ulab.numpy as np
 import ulab.utils
-import simpleio
 
 import hardware
+import inputs
+
+def _mel(f):
+    return 2595 * math.log(1 + f / 700) / math.log(10)
+
+def _mel_to_hz(m):
+    return 700 * (10 ** (m / 2595) - 1)
+
+def band_edges(sr, n_fft, n_bands, f_min, f_max, spacing="log"):
+    """
+    FFT bin edges for n_bands bands between f_min and f_max, spaced evenly on a log or mel scale.
+
+    Every band gets at least one bin, so at the low end the bands are one bin wide until the spacing catches up,
+    and none go past the Nyquist bin.
+
+    :return: n_bands + 1 bin indexes, band i is bins edges[i] to edges[i + 1] - 1
+    :rtype: list
+    """
+    bin_hz = sr / n_fft
+    if spacing == "mel":
+        lo, hi = _mel(f_min), _mel(f_max)
+        freqs = [_mel_to_hz(lo + (hi - lo) * i / n_bands) for i in range(n_bands + 1)]
+    else:
+        freqs = [f_min * (f_max / f_min) ** (i / n_bands) for i in range(n_bands + 1)]
+
+    edges = [max(1, round(f / bin_hz)) for f in freqs]
+    for i in range(1, n_bands + 1):
+        edges[i] = max(edges[i], edges[i - 1] + 1)
+    last = n_fft // 2 + 1
+    for i in range(n_bands, -1, -1):
+        edges[i] = min(edges[i], last - (n_bands - i))
+    return edges
+
+def make_window(kind, n):
+    """
+    Hann or Hamming window of n points, or None for no window.
+    """
+    if kind == "hann":
+        a = 0.5
+    elif kind == "hamming":
+        a = 0.54
+    else:
+        return None
+    return a - (1 - a) * np.cos(np.arange(n) * (2 * math.pi / (n - 1)))
 
 class Visualizer:
     def __init__(self, title):
         self.title = title
 
-        self.sr = 22000  # Sampling rate
-        self.sample_ct = 1024  # Sample count
-        self.peak = [31] * 32  # Array to hold the maximum value of the variable pxy
-        self.gain_f = 1000000  # You can adjust the gain by changing this value
-        self.nyquist = self.sample_ct // 2 + 1  # Nyquist value
+        # FFT modes, the knob switches between them.
+        # Small FFTs update faster for following rhythm, big ones resolve the spectrum better.
+        self.modes = [
+            {"name": "Fast", "size": 256, "rate": 11000, "window": "hann"},
+            {"name": "Normal", "size": 512, "rate": 22000, "window": "hann"},
+            {"name": "Hi-res", "size": 1024, "rate": 22000, "window": "hamming"},
+        ]
+        self.curr_mode = 1
+        self.windows = {}  # precomputed windows by (kind, size)
+
+        self.columns = 16
+        self.rows = 16
+        # Top row of each column's bar, self.rows = empty. Peaks fall by decay rows per frame.
+        self.peak = np.full(self.columns, self.rows, dtype=np.uint8)
+        self.decay = 2
+        self.tile_colors = [15 - row // 2 for row in range(self.rows)]
+
+        # print band levels and frame rate to the console
+        self.debug = False
+        self.frames = 0
+        self.fps_t0 = time.monotonic()
+        # Bands are mapped to rows on a dB scale, adjust the range to change the gain.
+        # The range is for a 1024 point FFT without a window, set_mode() corrects it for the others.
+        self.db_min = 84
+        self.db_max = 120
+        self.db_scale = self.rows / (self.db_max - self.db_min)
 
-        self.samples = array.array('H', [0] * (self.sample_ct+3))
+        self.raw = ()  # views of the capture buffers, set up on entering
 
         self.sprite_sheet, palette = adafruit_imageload.load("/files/HeatMap_sprites_4x4.bmp",
                                                         bitmap=displayio.Bitmap,
@@ -30,55 +98,160 @@ class Visualizer:
         self.sprite_hd = displayio.TileGrid(
             self.sprite_sheet,
             pixel_shader=palette,
-            width=16,
-            height=16,
+            width=self.columns,
+            height=self.rows,
             tile_width=4,
             tile_height=4)
 
+        self.label_mode = label.Label(terminalio.FONT, text="", color=0xFFFFFF, x=72, y=8)
+
         self.screen = displayio.Group(scale=1)
         self.screen.append(self.sprite_hd)
+        self.screen.append(self.label_mode)
+
+        # Waterfall, red button toggles it. One pixel row per band, newest spectrum on the right.
+        # Columns are written into a ring in the bitmap, and two TileGrids showing the same bitmap side by side
+        # are moved so the oldest column is at the left, so scrolling never redraws the whole screen.
+        # The OLED is 1 bit, so a pixel is lit when its band is more than wf_threshold dB above the floor.
+        self.waterfall = False
+        self.wf_threshold = (self.db_max - self.db_min) / 2
+        self.wf_bitmap = displayio.Bitmap(hardware.DISP_WIDTH, hardware.DISP_HEIGHT, 2)
+        wf_palette = displayio.Palette(2)
+        wf_palette[0] = 0x000000
+        wf_palette[1] = 0xFFFFFF
+        self.wf_grids = (
+            displayio.TileGrid(self.wf_bitmap, pixel_shader=wf_palette),
+            displayio.TileGrid(self.wf_bitmap, pixel_shader=wf_palette, x=hardware.DISP_WIDTH),
+        )
+        self.wf_head = 0  # next column to write, which is also the oldest
+        self.wf_screen = displayio.Group()
+        for grid in self.wf_grids:
+            self.wf_screen.append(grid)
+
+        self.set_mode(self.curr_mode)
+
+    def set_mode(self, index):
+        mode = self.modes[index]
+        self.curr_mode = index
+        self.sr = mode["rate"]
+        self.sample_ct = mode["size"]
+        self.frame = np.zeros(self.sample_ct)
+
+        key = (mode["window"], self.sample_ct)
+        if key not in self.windows:
+            self.windows[key] = make_window(mode["window"], self.sample_ct)
+        self.window = self.windows[key]
+
+        # FFT magnitudes scale with the size and the window's average gain
+        gain = self.sample_ct * (np.mean(self.window) if self.window is not None else 1)
+        self.db_floor = self.db_min + 20 * math.log10(gain / 1024)
+
+        self.bins = np.arange(self.sample_ct // 2 + 1, dtype=np.float)
+        self.band_points, self.band_width = self._build_bands(self.columns, f_min=60, f_max=self.sr / 2, spacing="log")
+        # bottom row is the lowest band
+        self.wf_points, self.wf_width = self._build_bands(self.wf_bitmap.height, f_min=60, f_max=self.sr / 2,
+                                                           spacing="log", reverse=True)
+        self.label_mode.text = mode["name"]
+        print("Visualizer mode", mode["name"], self.sample_ct, "points at", self.sr, "Hz")
 
     def enter(self):
-        hardware.display.show(self.screen)
+        hardware.display.show(self.wf_screen if self.waterfall else self.screen)
+        self._start_capture()
+
+    def _start_capture(self):
+        hardware.mic.start(self.sample_ct, self.sr)
+        self.raw = [np.frombuffer(half, dtype=np.uint16) for half in hardware.mic.halves]
 
     def exit(self):
-        pass  # nothing to do
+        hardware.mic.stop()
+
+    def _build_bands(self, n_bands, f_min, f_max, spacing, reverse=False):
+        """
+        Work out once which FFT bins go into each band.
+
+        ulab has no reduceat, so to get the peak of every band in one go the spectrum is gathered into a
+        n_bands x width table with np.interp at whole bin indexes (bins repeat to fill the narrower bands)
+        and np.max is taken along each row. See _band_peaks.
 
-    def handle_joystick(self, joy_xy):
-        pass # nothing to do
+        :return: the interp points and the width of the table
+        :rtype: tuple
+        """
+        edges = band_edges(self.sr, self.sample_ct, n_bands, f_min, min(f_max, self.sr / 2), spacing)
+        width = max(edges[i + 1] - edges[i] for i in range(n_bands))
+        points = []
+        for i in (range(n_bands - 1, -1, -1) if reverse else range(n_bands)):
+            lo, n = edges[i], edges[i + 1] - edges[i]
+            points.extend(lo + (j * n) // width for j in range(width))
+        return np.array(points), width
 
-    def handle_key_event(self, event):
-        print("App currently doesn't handle any keys")
+    def _band_peaks(self, f, points, width):
+        bands = np.interp(points, self.bins, f[:len(self.bins)])
+        return np.max(bands.reshape((len(points) // width, width)), axis=1)
+
+    def handle_event(self, event):
+        if event.kind == inputs.ENCODER:
+            self.set_mode((self.curr_mode + (1 if event.value > 0 else -1)) % len(self.modes))
+            self._start_capture()
+        elif event.kind == inputs.CLICK and event.key == hardware.KEY_BTN and event.value == 1:
+            self.waterfall = not self.waterfall
+            hardware.display.show(self.wf_screen if self.waterfall else self.screen)
 
     def loop_handler(self):
-        hardware.mic_readinto(self.samples, self.sr)
+        # remove DC and apply the window in place in the float frame buffer
+        frame = self.frame
+        frame[:] = self.raw[hardware.mic.read()]
+        frame -= np.mean(frame)
+        if self.window is not None:
+            frame *= self.window
+
+        f = ulab.utils.spectrogram(frame)  # FFT(absolute)
 
-        samparray = np.array(self.samples[3:])
+        if self.waterfall:
+            self.update_waterfall(f)
+        else:
+            self.update_bars(f)
 
-        f = ulab.utils.spectrogram(samparray)  # FFT(absolute)
+        if self.debug:
+            self.frames += 1
+            if self.frames == 100:
+                now = time.monotonic()
+                print("Visualizer", self.frames / (now - self.fps_t0), "fps")
+                self.fps_t0 = now
+                self.frames = 0
 
-        step = self.sample_ct // 32
-        for i in range(step, self.nyquist, step):  # Discard first 3 values
-            pxx = int((i - step + 1) / step)  # x of sprite
+    def update_waterfall(self, f):
+        # threshold each band's dB level to on/off and blit it in as one column
+        peaks = self._band_peaks(f, self.wf_points, self.wf_width)
+        column = np.array(20 * np.log10(peaks + 1) - self.db_floor >= self.wf_threshold, dtype=np.uint8)
+        head = self.wf_head
+        bitmaptools.arrayblit(self.wf_bitmap, column, x1=head, y1=0, x2=head + 1, y2=self.wf_bitmap.height)
 
-            fmax4 = max(f[i:i + step - 1]) - 15000 # Get max value of every four of f
-            # map fmax4 value
-            pxy = int(simpleio.map_range(fmax4, 0, self.gain_f, 15, 0))
+        head = (head + 1) % self.wf_bitmap.width
+        self.wf_grids[0].x = -head
+        self.wf_grids[1].x = self.wf_bitmap.width - head
+        self.wf_head = head
 
-            #print(pxx, pxy)
-            print(i, fmax4, pxx, pxy)
+    def update_bars(self, f):
+        # peak of each band, then dB to sprite row (0 = loudest)
+        peaks = self._band_peaks(f, self.band_points, self.band_width)
+        levels = np.clip((20 * np.log10(peaks + 1) - self.db_floor) * self.db_scale, 0, self.rows - 1)
+        pxys = np.array(self.rows - 1 - levels, dtype=np.uint8)
 
-            if self.peak[pxx] > pxy:
-                self.peak[pxx] = pxy  # update the peak array
-            elif self.peak[pxx] < 14:
-                self.peak[pxx] = self.peak[pxx] + 2  # move pixels down by 2
+        # new peaks jump up, old ones fall
+        peak = np.minimum(pxys, np.minimum(self.peak + self.decay, self.rows))
 
-            # Clear existing sprites
-            if self.peak[pxx] > 0:
-                self.sprite_hd[pxx, self.peak[pxx] - 1] = 0
-            if self.peak[pxx] > 1:
-                self.sprite_hd[pxx, self.peak[pxx] - 2] = 0
-                # Place sprites
-                self.sprite_hd[pxx, self.peak[pxx]] = 15 - int(self.peak[pxx]/2)
+        # only write the tiles between the old and new top of each bar that moved
+        old_peak = self.peak
+        for pxx in np.nonzero(peak != old_peak)[0]:
+            pxx = int(pxx)
+            old, new = old_peak[pxx], peak[pxx]
+            if new < old:
+                for row in range(new, old):
+                    self.sprite_hd[pxx, row] = self.tile_colors[row]
+            else:
+                for row in range(old, new):
+                    self.sprite_hd[pxx, row] = 0
+        self.peak = peak
 
-        hardware.display.show(self.screen)
+        if self.debug:
+            print(pxys)
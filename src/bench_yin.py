@@ -0,0 +1,35 @@
+"""
+Benchmark for the YIN difference functions. Copy to the board and run from the REPL with `import bench_yin`.
+
+Times the convolve and FFT versions of the difference function on a test tone at each window size,
+and checks that both give the same df.
+"""
+
+import time
+import math
+import ulab.numpy as np
+
+import yin
+
+SAMPLE_RATE = 8000
+TEST_FREQ = 220
+REPEAT = 5
+
+def time_ms(diff_func, x, w_len, tau_max):
+    start = time.monotonic_ns()
+    for _ in range(REPEAT):
+        df = diff_func(x, w_len, tau_max)
+    return df, (time.monotonic_ns() - start) / REPEAT / 1000000
+
+def run(w_lens=(256, 512, 1024)):
+    for w_len in w_lens:
+        tau_max = w_len // 2
+        x = np.sin(np.arange(w_len) * (2 * math.pi * TEST_FREQ / SAMPLE_RATE))
+
+        df_conv, t_conv = time_ms(yin.difference_function, x, w_len, tau_max)
+        df_fft, t_fft = time_ms(yin.difference_function_fft, x, w_len, tau_max)
+        err = np.max(abs(df_conv - df_fft)) / np.max(df_conv)
+
+        print(f'w_len {w_len:5}: convolve {t_conv:8.1f} ms, fft {t_fft:7.1f} ms, speedup {t_conv / t_fft:5.1f}x, rel err {err:.2e}')
+
+run()
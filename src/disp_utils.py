@@ -1,5 +1,6 @@
 import displayio
 import terminalio
+import ulab.numpy as np
 from adafruit_display_text import label
 
 import hardware
@@ -35,4 +36,50 @@ class OLEDDisplay:
 
         hardware.display.show(self.simple_screen)
 
+class Waveform:
+    """
+    Waveform plot drawn straight into a 1-bit Bitmap, one dot per column.
+
+    update() decimates the samples and maps them to rows with vector ops, then only touches the columns whose
+    row has changed since the last frame, instead of rebuilding line shapes like Sparkline does.
+    """
+
+    def __init__(self, width, height, v_min, v_max, x=0, y=0):
+        self.width = width
+        self.height = height
+        self.bitmap = displayio.Bitmap(width, height, 2)
+        palette = displayio.Palette(2)
+        palette[0] = 0x000000
+        palette[1] = 0xFFFFFF
+        self.grid = displayio.TileGrid(self.bitmap, pixel_shader=palette, x=x, y=y)
+
+        # value -> row, with v_max at the top
+        self.scale = (1 - height) / (v_max - v_min)
+        self.offset = (height - 1) - v_min * self.scale
+        mid = int(self.offset + self.scale * (v_min + v_max) / 2)
+        self.rows = np.full(width, mid, dtype=np.uint8)
+        for i in range(width):
+            self.bitmap[i, mid] = 1
+
+    def update(self, values):
+        """
+        Plot the latest samples of values, decimated if there are at least twice as many as columns.
+
+        :param values: samples (ndarray)
+        """
+        step = max(1, len(values) // self.width)
+        start = len(values) - step * self.width
+        if start < 0:
+            return
+        rows = np.array(np.clip(values[start::step] * self.scale + self.offset, 0, self.height - 1), dtype=np.uint8)
+
+        bitmap = self.bitmap
+        old_rows = self.rows
+        for i in np.nonzero(rows != old_rows)[0]:
+            i = int(i)
+            bitmap[i, old_rows[i]] = 0
+            bitmap[i, rows[i]] = 1
+        old_rows[:] = rows
+
+
 display = OLEDDisplay()
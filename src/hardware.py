@@ -1,12 +1,21 @@
+import array
+import struct
+import time
 import board
 import digitalio
 import rotaryio
 import analogbufio
+import audiobusio
+import audiocore
+import audiomixer
 import busio
+import keypad
+from adafruit_ticks import ticks_ms, ticks_diff
 import adafruit_pcf8575
 from adafruit_debouncer import Button
 import displayio
 import adafruit_displayio_ssd1306
+import ulab.numpy as np
 
 # Controls
 ROT_LEFT = board.GP19
@@ -24,6 +33,8 @@ IO_ADDR = 0x20
 IO_SCL = board.GP7
 IO_SDA = board.GP6
 
+IO_INT = None  # pin wired to the expander's INT output, if any, e.g. board.GP8
+
 IO_FS1 = 8
 IO_FS2 = 9
 
@@ -47,10 +58,15 @@ KEYS_MAP = {
 
 # Audio
 MIC_IN = board.A2
+MIC_SHIFT = 16      # 16-bit readings down to the ADC's 12 bits
+MIC_MIDPOINT = 2048  # mic output is biased at half supply
 
 SND_BCLK = board.GP12
 SND_LRC = board.GP13
 SND_DIN = board.GP14
+SND_RATE = 22050    # the click wavs' own rate, so they play without resampling
+SND_VOICES = 4
+SND_BUFFER = 4096   # mixer buffer in bytes. sufficient buffer_size needed to prevent glitches. too high and timing will be off.
 
 # LED
 LED_RING = board.GP16
@@ -66,32 +82,366 @@ DISP_WIDTH = 128
 DISP_HEIGHT = 64
 
 enc = rotaryio.IncrementalEncoder(ROT_LEFT, ROT_RIGHT)
-enc_last_pos = enc.position
 
 
-def mic_readinto(buffer, sample_rate):
-    mic = analogbufio.BufferedIn(MIC_IN, sample_rate=sample_rate)
-    mic.readinto(buffer)
-    mic.deinit()
+class MicCapture:
+    """
+    Mic capture that keeps its BufferedIn open between reads, with two buffers used ping-pong style.
+
+    An app calls start() with its block size and sample rate when entered, read() every loop and stop() when
+    it exits, so the peripheral is created once per app rather than once per frame.
+
+    Where the firmware supports readinto(loop=True), the ADC fills both halves of one buffer continuously in the
+    background and read() returns whichever half was completed last, so one block is processed while the next
+    one fills. There's no way to ask the DMA where it is, so that is worked out from the time since the capture
+    was started, and the capture is restarted every RESYNC_BLOCKS blocks so the ADC and CPU clocks can't drift
+    apart. Without loop support, read() does a blocking readinto into the next half instead.
+
+    After each read(), self.skipped says how many blocks were lost just before the one returned: blocks the caller
+    was too late for, or one for the gap when the capture was restarted. In blocking mode there is always a gap
+    between reads, so it is always at least 1. Anything that needs continuous audio should start over when it's
+    not 0.
+    """
+
+    RESYNC_BLOCKS = 256
+
+    def __init__(self, pin):
+        self.pin = pin
+        self.adc = None
+        self.sample_rate = 0
+        self.block = 0
+        self.looping = False
+        self.buffer = None
+        self.halves = ()
+        self.skipped = 0
+
+    def start(self, block, sample_rate):
+        """
+        Start capturing blocks of block samples at sample_rate.
+
+        Afterwards self.halves holds the two memoryviews that read() returns indexes into.
+        """
+        self.stop()
+        self.adc = analogbufio.BufferedIn(self.pin, sample_rate=sample_rate)
+        self.sample_rate = sample_rate
+
+        if block != self.block:
+            self.block = block
+            self.buffer = array.array("H", [0] * (2 * block))
+            view = memoryview(self.buffer)
+            self.halves = (view[:block], view[block:])
+        self.block_ns = 1000000000 * block // sample_rate
+        self.current = 1
+        self.skipped = 0
+        self._start_loop()
+
+    def _start_loop(self):
+        try:
+            self.adc.readinto(self.buffer, loop=True)
+            self.looping = True
+        except TypeError:  # firmware without continuous capture
+            self.looping = False
+        self.t0 = time.monotonic_ns()
+        self.blocks = 0
+
+    def stop(self):
+        if self.adc is not None:
+            self.adc.deinit()
+            self.adc = None
+        self.looping = False
+
+    def read(self):
+        """
+        Wait for the next block of samples.
+
+        :return: index into self.halves of the buffer holding it
+        :rtype: int
+        """
+        if not self.looping:
+            self.current ^= 1
+            self.adc.readinto(self.halves[self.current])
+            self.skipped = 1  # whatever happened since the last read wasn't captured
+            return self.current
+
+        restarted = 0
+        if self.blocks >= self.RESYNC_BLOCKS:
+            self.adc.deinit()
+            self.adc = analogbufio.BufferedIn(self.pin, sample_rate=self.sample_rate)
+            self._start_loop()
+            restarted = 1
+
+        # blocks completed since the capture started; block n goes into half n % 2
+        elapsed = time.monotonic_ns() - self.t0
+        done = elapsed // self.block_ns
+        if done <= self.blocks:
+            # caught up with the ADC, wait for the block being filled now
+            done = self.blocks + 1
+            time.sleep((done * self.block_ns - elapsed) / 1000000000)
+        self.skipped = done - self.blocks - 1 + restarted
+        self.blocks = done
+        self.current = (done - 1) % 2
+        return self.current
+
+def load_wav(path, sample_rate):
+    """
+    Read a 16-bit mono wav file into RAM, decimated to sample_rate (which should divide the file's rate).
+
+    When decimating, each output sample is the average of the input samples it replaces, a simple low-pass filter
+    so the higher frequencies don't alias.
+
+    :return: samples
+    :rtype: array.array
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+
+    pos = 12  # skip the RIFF header
+    file_rate = sample_rate
+    pcm = b""
+    while pos + 8 <= len(data):
+        chunk, size = struct.unpack_from("<4sI", data, pos)
+        if chunk == b"fmt ":
+            file_rate = struct.unpack_from("<I", data, pos + 12)[0]
+        elif chunk == b"data":
+            pcm = memoryview(data)[pos + 8:pos + 8 + size]
+        pos += 8 + size + (size & 1)
+
+    src = np.frombuffer(pcm, dtype=np.int16)
+    factor = max(1, file_rate // sample_rate)
+    if factor > 1:
+        n = len(src) // factor
+        acc = np.zeros(n)
+        for i in range(factor):
+            acc += src[i:n * factor:factor]
+        src = np.array(acc / factor, dtype=np.int16)
+    samples = array.array("h", bytes(2 * len(src)))
+    np.frombuffer(samples, dtype=np.int16)[:] = src
+    return samples
+
+
+class AudioEngine:
+    """
+    One I2S output and mixer shared by all the apps, running from start-up so switching apps doesn't glitch.
+
+    An app takes mixer voices with attach() when entered and hands them back with detach() when it exits.
+    Samples are decoded from their wav files into RAM the first time they're asked for and kept, so nothing is
+    read from flash while playing. Everything is signed 16-bit mono at SND_RATE.
+    """
+
+    def __init__(self, voice_count=SND_VOICES, sample_rate=SND_RATE):
+        self.sample_rate = sample_rate
+        self.i2s = audiobusio.I2SOut(SND_BCLK, SND_LRC, SND_DIN)
+        self.mixer = audiomixer.Mixer(voice_count=voice_count, buffer_size=SND_BUFFER, sample_rate=sample_rate,
+                        channel_count=1, bits_per_sample=16, samples_signed=True)
+        # time from a voice starting to it being heard: the mixer fills one buffer of 16-bit samples ahead of the DAC
+        self.latency_ns = 1000000000 * (SND_BUFFER // 2) // sample_rate
+        self.i2s.play(self.mixer)
+        self.free = list(range(voice_count))
+        self.clips = {}
+        self.samples = {}
+
+    def attach(self, count=1):
+        """
+        Take count free voices.
+
+        :return: the voices, index into self.mixer.voice
+        :rtype: list
+        """
+        if count > len(self.free):
+            raise RuntimeError(f"{count} voices wanted, {len(self.free)} free")
+        voices = self.free[:count]
+        del self.free[:count]
+        return voices
+
+    def detach(self, voices):
+        """
+        Stop voices and hand them back.
+        """
+        for v in voices:
+            self.mixer.voice[v].stop()
+            self.mixer.voice[v].level = 1.0
+            self.free.append(v)
+        voices.clear()
+
+    def play(self, voice, sample, loop=False):
+        self.mixer.voice[voice].play(sample, loop=loop)
 
+    def stop(self, voice):
+        self.mixer.voice[voice].stop()
 
-def encoder_get_change():
-    global enc_last_pos
-    change = enc.position - enc_last_pos
-    enc_last_pos = enc.position
-    return change
+    def clip(self, path):
+        """
+        Samples of a wav file, loaded into RAM on first use.
 
-def clicked(keynum):
-    return True if keys[keynum].short_count == 1 else False
+        :rtype: array.array
+        """
+        if path not in self.clips:
+            self.clips[path] = load_wav(path, self.sample_rate)
+        return self.clips[path]
 
-def double_clicked(keynum):
-    return True if keys[keynum].short_count == 2 else False
+    def sample(self, path):
+        """
+        A wav file as a RawSample that can be played on a voice, loaded into RAM on first use.
 
-def long_clicked(keynum):
-    return True if keys[keynum].long_press else False
+        :rtype: audiocore.RawSample
+        """
+        if path not in self.samples:
+            self.samples[path] = audiocore.RawSample(self.clip(path), sample_rate=self.sample_rate)
+        return self.samples[path]
 
-def long_double_clicked(keynum):
-    return True if keys[keynum].long_press and keys[keynum].short_count == 1 else False
+
+def mic_to_int16(raw, out):
+    """
+    Convert unsigned 16-bit mic readings to signed 12-bit samples centred on zero.
+
+    Pass np.frombuffer() of the capture array as raw so nothing is copied. This is all vector ops on integer
+    arrays, so there's no per-sample Python loop, and out takes half the memory of a float array.
+    """
+    out[:] = raw // MIC_SHIFT
+    out -= MIC_MIDPOINT
+    return out
+
+
+class ExpanderScanner:
+    """
+    Reads all 16 IO expander inputs in one I2C transaction per scan, for all the expander keys to debounce from.
+
+    scan() is called once per loop before the keys are updated, and the key predicates from pin() just test a bit of
+    the last snapshot, so adding keys on the expander costs nothing extra. If the expander's INT line is wired up
+    (IO_INT), the port is only read when it signals that an input changed.
+    """
+
+    def __init__(self, expander, int_pin=None):
+        self.expander = expander
+        self.int = None
+        if int_pin is not None:
+            self.int = digitalio.DigitalInOut(int_pin)
+            self.int.direction = digitalio.Direction.INPUT
+            self.int.pull = digitalio.Pull.UP
+        self.expander.write_gpio(0xFFFF)  # release every pin so they can all be read as inputs (pulled up)
+        self.state = self.expander.read_gpio()
+
+    def scan(self):
+        # INT goes low on any change and is cleared by reading the port
+        if self.int is None or not self.int.value:
+            self.state = self.expander.read_gpio()
+
+    def pin(self, n):
+        """
+        Predicate for a Button on expander pin n.
+        """
+        mask = 1 << n
+        return lambda: bool(self.state & mask)
+
+
+class KeyGestures:
+    """
+    Short, double and long press detection for a key, from timestamped press and release events.
+
+    Has the same short_count, long_press, pressed, released and value as adafruit_debouncer's Button, with the same
+    timings, so inputs.update() can treat them alike. The timing comes from the event timestamps rather than from when
+    the loop gets round to them, so a busy loop_handler doesn't change what counts as a short or long press. If more
+    than one gesture completes between loops, they're reported one per loop in order.
+    """
+
+    SHORT_MS = 200  # gap after a release that ends a run of short presses
+    LONG_MS = 500   # hold time for a long press
+
+    def __init__(self):
+        self.value = True  # released, like a pulled up pin
+        self.count = 0     # short presses so far in this run
+        self.down_at = 0
+        self.up_at = 0
+        self.long_fired = False
+        self.done = []     # gestures completed but not reported yet, as (long_press, short_count)
+        self._clear()
+
+    def _clear(self):
+        self.short_count = 0
+        self.long_press = False
+        self.pressed = False
+        self.released = False
+
+    def event(self, pressed, timestamp):
+        """
+        Feed in one press or release. Gestures that it completes are decided here from the timestamps.
+        """
+        if pressed:
+            # a press after the gap starts a new run, the one before it was complete
+            if self.count and ticks_diff(timestamp, self.up_at) >= self.SHORT_MS:
+                self.done.append((False, self.count))
+                self.count = 0
+            self.value = False
+            self.pressed = True
+            self.down_at = timestamp
+            self.long_fired = False
+        else:
+            self.value = True
+            self.released = True
+            self.up_at = timestamp
+            if self.long_fired:
+                self.count = 0
+            elif ticks_diff(timestamp, self.down_at) >= self.LONG_MS:
+                # held long enough, even if the loop didn't see it while it was down
+                self.done.append((True, self.count))
+                self.count = 0
+            else:
+                self.count += 1
+
+    def update(self, now):
+        """
+        Report one completed gesture. Call once per loop after feeding in the events.
+
+        now is only used for gestures that are still going on: a key still held past LONG_MS, or a run of short
+        presses with no press since.
+        """
+        if not self.value:
+            if not self.long_fired and ticks_diff(now, self.down_at) >= self.LONG_MS:
+                self.done.append((True, self.count))  # 1 means a short press then a long one
+                self.long_fired = True
+                self.count = 0
+        elif self.count and ticks_diff(now, self.up_at) >= self.SHORT_MS:
+            self.done.append((False, self.count))
+            self.count = 0
+
+        if self.done:
+            self.long_press, self.short_count = self.done.pop(0)
+
+
+class NativeKeys:
+    """
+    Keys on the Pico's own pins, scanned in the background by keypad.Keys.
+
+    Presses are queued with timestamps however busy the main loop is, and update() drains the queue into each
+    key's KeyGestures.
+    """
+
+    def __init__(self, pins):
+        self.scanner = keypad.Keys(pins, value_when_pressed=False, pull=True)
+        self.keys = [KeyGestures() for _ in pins]
+        self.event = keypad.Event()  # reused, so draining the queue doesn't allocate
+
+    def update(self):
+        for key in self.keys:
+            key._clear()
+        if self.scanner.events.overflowed:
+            print("Key events lost")
+            self.scanner.events.clear()
+        while self.scanner.events.get_into(self.event):
+            self.keys[self.event.key_number].event(self.event.pressed, self.event.timestamp)
+        now = ticks_ms()
+        for key in self.keys:
+            key.update(now)
+
+
+def update_keys():
+    """
+    Update the state of all the keys, call once per loop.
+    """
+    native_keys.update()
+    io_scanner.scan()
+    for key in io_keys:
+        key.update()
 
 
 
@@ -102,25 +452,28 @@ spi = busio.SPI(clock=DISP_SCK, MOSI=DISP_SDA)
 display_bus = displayio.FourWire(spi, command=DISP_DC, chip_select=DISP_CS, reset=DISP_RST, baudrate=1000000)
 display = adafruit_displayio_ssd1306.SSD1306(display_bus, width=DISP_WIDTH, height=DISP_HEIGHT)
 
+mic = MicCapture(MIC_IN)
+audio = AudioEngine()
+
 io_bus = busio.I2C(scl=IO_SCL, sda=IO_SDA)
 io = adafruit_pcf8575.PCF8575(io_bus, address=IO_ADDR)
-io_fs1 = io.get_pin(IO_FS1)  # tests if board is working
-#print(io_fs1.value)
+io_scanner = ExpanderScanner(io, IO_INT)  # tests if board is working
+#print(hex(io_scanner.state))
 
 # Init button pins
 
 keys = {}
+io_keys = []
+
+native_pins = [KEYS_MAP[i]["value"] for i in KEYS_MAP.keys() if KEYS_MAP[i]["source"] == SRC_PIN]
+native_keys = NativeKeys(native_pins)
 
 for i in KEYS_MAP.keys():
     if KEYS_MAP[i]["source"] == SRC_PIN:
-        pin = digitalio.DigitalInOut(KEYS_MAP[i]["value"])
-        pin.direction = digitalio.Direction.INPUT
-        pin.pull = digitalio.Pull.UP
-        keys[i] = Button(pin)
+        keys[i] = native_keys.keys[native_pins.index(KEYS_MAP[i]["value"])]
     elif KEYS_MAP[i]["source"] == SRC_IO:
-        predicate = lambda x: io.get_pin(x)
-        io_pin = KEYS_MAP[i]["value"]
-        keys[i] = Button(predicate(io_pin))
+        keys[i] = Button(io_scanner.pin(KEYS_MAP[i]["value"]))
+        io_keys.append(keys[i])
     else:
         print("Unknown key: ", KEYS_MAP[i]["source"])
 
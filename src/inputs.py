@@ -0,0 +1,138 @@
+"""
+Input events for the apps.
+
+Once per loop, update() turns what happened on the keys, the encoder and the joystick into events in a
+preallocated ring, and the switcher hands them to the active app's handle_event(). An app that has nothing to do
+with an input just doesn't get called for it.
+
+Events:
+    CLICK     key was short pressed value times in a row (1 = click, 2 = double click)
+    LONG      key was held down, after value short presses (1 = short then long)
+    ENCODER   encoder turned by value steps
+    JOYSTICK  joystick position x, y (-100 to 100) while it's off centre, and once when it's back to centre.
+              Only for apps that ask for it with use_joystick(True) when entered, otherwise it isn't read at all.
+"""
+
+import array
+from adafruit_ticks import ticks_ms
+
+import hardware
+import joystick
+
+CLICK = 0
+LONG = 1
+ENCODER = 2
+JOYSTICK = 3
+
+class InputEvent:
+    def __init__(self):
+        self.kind = 0
+        self.key = 0
+        self.value = 0
+        self.x = 0
+        self.y = 0
+        self.timestamp = 0
+
+    def __repr__(self):
+        return f"InputEvent({self.kind}, key={self.key}, value={self.value}, x={self.x}, y={self.y}, t={self.timestamp})"
+
+
+class EventQueue:
+    """
+    Ring of events stored in flat arrays, so nothing is allocated as events come and go.
+
+    If it fills up, new events are dropped and counted in self.dropped.
+    """
+
+    def __init__(self, size=32):
+        self.size = size
+        self.kind = bytearray(size)
+        self.key = bytearray(size)
+        self.value = array.array("h", [0] * size)
+        self.x = array.array("h", [0] * size)
+        self.y = array.array("h", [0] * size)
+        self.timestamp = array.array("L", [0] * size)
+        self.head = 0  # next to read
+        self.tail = 0  # next to write
+        self.dropped = 0
+
+    def __len__(self):
+        return self.tail - self.head
+
+    def put(self, kind, key=0, value=0, x=0, y=0, timestamp=0):
+        if self.tail - self.head >= self.size:
+            self.dropped += 1
+            return
+        i = self.tail % self.size
+        self.kind[i] = kind
+        self.key[i] = key
+        self.value[i] = value
+        self.x[i] = x
+        self.y[i] = y
+        self.timestamp[i] = timestamp
+        self.tail += 1
+
+    def get_into(self, event):
+        """
+        Copy the oldest event into event and remove it.
+
+        :return: False if there were no events
+        :rtype: bool
+        """
+        if self.head == self.tail:
+            return False
+        i = self.head % self.size
+        event.kind = self.kind[i]
+        event.key = self.key[i]
+        event.value = self.value[i]
+        event.x = self.x[i]
+        event.y = self.y[i]
+        event.timestamp = self.timestamp[i]
+        self.head += 1
+        if self.head == self.tail:
+            self.head = self.tail = 0
+        return True
+
+    def clear(self):
+        self.head = self.tail = 0
+
+
+queue = EventQueue()
+enc_last_pos = hardware.enc.position
+joy_last = (0, 0)
+joy_enabled = False
+
+def use_joystick(enabled):
+    """
+    Turn joystick events on or off, for the app being entered or exited.
+    """
+    global joy_enabled, joy_last
+    joy_enabled = enabled
+    joy_last = (0, 0)
+    joystick.reset()
+
+def update():
+    """
+    Scan all the inputs and queue events for whatever happened since the last call.
+    """
+    global enc_last_pos, joy_last
+
+    hardware.update_keys()
+    now = ticks_ms()
+    for keynum, key in hardware.keys.items():
+        if key.long_press:
+            queue.put(LONG, keynum, key.short_count, timestamp=now)
+        elif key.short_count:
+            queue.put(CLICK, keynum, key.short_count, timestamp=now)
+
+    # read the position once, so no counts get lost between reading and storing it
+    pos = hardware.enc.position
+    if pos != enc_last_pos:
+        queue.put(ENCODER, value=pos - enc_last_pos, timestamp=now)
+        enc_last_pos = pos
+
+    if joy_enabled:
+        joy_xy = joystick.read_joystick()
+        if joy_xy != (0, 0) or joy_last != (0, 0):
+            queue.put(JOYSTICK, x=joy_xy[0], y=joy_xy[1], timestamp=now)
+        joy_last = joy_xy
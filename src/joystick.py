@@ -1,5 +1,19 @@
+"""
+Joystick reading, all in integer maths.
+
+Each read oversamples both ADCs, scales against the centre found by calibrate() to -100..100 separately for each
+side, smooths with a running average and applies the deadzone. The deadzone is the bigger of DEADZONE and the
+noise seen while calibrating.
+
+MouseMotion turns the position into cursor or scroll wheel speed through a lookup table, and accumulates the
+movement in fixed point over the actual time between loops, sending one HID report per REPORT_MS.
+
+Nothing is read unless an app asks for joystick events with inputs.use_joystick().
+"""
+
+import array
 import analogio
-import simpleio
+from adafruit_ticks import ticks_ms, ticks_diff
 
 import hardware
 
@@ -7,22 +21,88 @@ x_axis = analogio.AnalogIn(hardware.JOY_X)
 y_axis = analogio.AnalogIn(hardware.JOY_Y)
 
 DEADZONE = 10
+MAX_DEADZONE = 30       # in case the stick wasn't let go while calibrating
+OVERSAMPLE_SHIFT = 2    # 4 ADC reads per axis per sample
+SMOOTH_SHIFT = 1        # running average weight 1/2 for each new sample
+CALIBRATION_SAMPLES = 32
+SCALE_SHIFT = 16        # fixed point for the scaling factors
 
 directions = ["E","SE","S","SW","W","NW","N","NE","0"]
 
+MOUSE_SPEED = 600       # pixels per second at full tilt
+WHEEL_SPEED = 15        # wheel steps per second at full tilt
+REPORT_MS = 10          # one mouse report per interval at most
+MAX_STEP_REPORTS = 4    # longest time counted between updates, in report intervals
+
+# fraction of full speed for each offset 0..100 from centre, in 1/1024ths. Squared for fine control near the centre.
+SPEED_CURVE = array.array("H", [n * n * 1024 // 10000 for n in range(101)])
+SPEED_ONE = 1024 * 1000  # accumulated units per pixel: curve fraction * ms
+
+def _read_raw():
+    x = 0
+    y = 0
+    for _ in range(1 << OVERSAMPLE_SHIFT):
+        x += x_axis.value
+        y += y_axis.value
+    return x >> OVERSAMPLE_SHIFT, y >> OVERSAMPLE_SHIFT
+
+class Axis:
+    def __init__(self):
+        self.set_centre(32768)
+        self.deadzone = DEADZONE
+        self.value = 0
+
+    def set_centre(self, centre):
+        self.centre = centre
+        # fixed point factors for raw offsets to -100..100 on each side, rounded up so the ends reach 100
+        neg = max(centre, 1)
+        pos = max(65535 - centre, 1)
+        self.scale_neg = ((100 << SCALE_SHIFT) + neg - 1) // neg
+        self.scale_pos = ((100 << SCALE_SHIFT) + pos - 1) // pos
+
+    def scale(self, raw):
+        d = raw - self.centre
+        if d < 0:
+            return max(-100, -((-d * self.scale_neg) >> SCALE_SHIFT))
+        return min(100, (d * self.scale_pos) >> SCALE_SHIFT)
+
+    def update(self, raw):
+        # step towards the target rounded half away from zero, the same on both sides, so it reaches +-100
+        d = self.scale(raw) - self.value
+        half = (1 << SMOOTH_SHIFT) >> 1
+        self.value += (d + half) >> SMOOTH_SHIFT if d >= 0 else -((half - d) >> SMOOTH_SHIFT)
+        return self.value if abs(self.value) > self.deadzone else 0
+
+axis_x = Axis()
+axis_y = Axis()
+
+def calibrate():
+    """
+    Take the current position as centre and set the deadzone from how noisy it is. Call with the stick let go.
+    """
+    samples = [_read_raw() for _ in range(CALIBRATION_SAMPLES)]
+    for i, axis in enumerate((axis_x, axis_y)):
+        values = [s[i] for s in samples]
+        axis.set_centre(sum(values) // CALIBRATION_SAMPLES)
+        noise = max(abs(axis.scale(v)) for v in values)
+        axis.deadzone = min(max(DEADZONE, 2 * noise), MAX_DEADZONE)
+    reset()
+
+def reset():
+    """
+    Clear the smoothing, e.g. when the joystick hasn't been read for a while.
+    """
+    axis_x.value = 0
+    axis_y.value = 0
+
 def read_joystick():
     """
     Read joystick pins and scale to range(-100, 100)
 
     Based on HW-S04 board oriented with pins on the left.
     """
-    x = int(simpleio.map_range(x_axis.value, 0, 65535, -100, 100))
-    y = int(simpleio.map_range(y_axis.value, 0, 65535, -100, 100))
-
-    # eliminate dead_zone
-    filter_x = x if abs(x) > DEADZONE else 0
-    filter_y = y if abs(y) > DEADZONE else 0
-    return (filter_x, filter_y)
+    raw_x, raw_y = _read_raw()
+    return (axis_x.update(raw_x), axis_y.update(raw_y))
 
 def direction(joy_xy):
     """
@@ -41,31 +121,77 @@ def direction(joy_xy):
     if x > 0 and y > 0: return "UR"
     if x < 0 and y > 0: return "UL"
 
-def accelerate(n, deadzone=DEADZONE):
-    if (abs(n) < deadzone):
-        return 0
-
-    if n < -80:
-        return -8
-    if n < -60:
-        return -6
-    if n < -40:
-        return -4
-    if n < -20:
-        return -2
+def _speed(n, full):
+    # speed in SPEED_ONE units per second, for offset n
+    return SPEED_CURVE[n] * full if n >= 0 else -SPEED_CURVE[-n] * full
 
-    if n > 80:
-        return 8
-    if n > 60:
-        return 6
-    if n > 40:
-        return 4
-    if n > 20:
-        return 2
+def _take(acc):
+    # whole steps in acc, rounded towards zero
+    return acc // SPEED_ONE if acc >= 0 else -(-acc // SPEED_ONE)
 
+class MouseMotion:
+    """
+    Moves the mouse (or scrolls its wheel) at a speed set by the joystick position, whatever the loop rate.
 
-    return 1
+    Call set_position() when the joystick moves and update() every loop. Movement is summed in fixed point over the
+    time since the last update, so fractions of a pixel carry over, and it's sent in at most one report every
+    report_ms.
+    """
 
-def get_mouse_move(joy_xy):
-    (x, y) = joy_xy
-    return (accelerate(x), accelerate(y))
+    def __init__(self, mouse, report_ms=REPORT_MS):
+        self.mouse = mouse
+        self.report_ms = report_ms
+        self.scroll = False
+        self.x = 0
+        self.y = 0
+        self.acc_x = 0
+        self.acc_y = 0
+        self.last = ticks_ms()
+        self.last_report = self.last
+
+    def set_position(self, x, y):
+        if self.x == 0 and self.y == 0:
+            # starting from rest, only count time from now
+            self.last = ticks_ms()
+            self.last_report = self.last
+        self.x = x
+        self.y = y
+        if x == 0 and y == 0:
+            # let go, don't leave a fraction of a pixel behind for next time
+            self.acc_x = 0
+            self.acc_y = 0
+
+    def set_scroll(self, scroll):
+        """
+        Switch between moving the cursor and scrolling the wheel with the joystick's up and down.
+        """
+        self.scroll = scroll
+        self.acc_x = 0
+        self.acc_y = 0
+
+    def update(self):
+        now = ticks_ms()
+        # a stalled loop moves the cursor at most a few reports' worth, never backwards if the ticks wrapped
+        dt = min(max(ticks_diff(now, self.last), 0), MAX_STEP_REPORTS * self.report_ms)
+        self.last = now
+        if self.x == 0 and self.y == 0:
+            return
+
+        full = WHEEL_SPEED if self.scroll else MOUSE_SPEED
+        self.acc_x += _speed(self.x, full) * dt
+        self.acc_y += _speed(self.y, full) * dt
+        if ticks_diff(now, self.last_report) < self.report_ms:
+            return
+        self.last_report = now
+
+        dx = _take(self.acc_x)
+        dy = _take(self.acc_y)
+        self.acc_x -= dx * SPEED_ONE
+        self.acc_y -= dy * SPEED_ONE
+        if self.scroll:
+            if dy:
+                self.mouse.move(wheel=-dy)  # stick down scrolls down
+        elif dx or dy:
+            self.mouse.move(dx, dy)
+
+calibrate()
@@ -0,0 +1,80 @@
+"""
+Note lookup for the tuner.
+
+The nearest note to a frequency is round(12 * log2(f / A4)) semitones away from A4, so there's no table to search
+and no limit on the range. A4 can be set to any reference (415, 440, 442...), and a temperament offset table can
+be applied on top of equal temperament.
+"""
+
+import math
+
+NOTE_NAMES = ("C", "C#/Db", "D", "D#/Eb", "E", "F", "F#/Gb", "G", "G#/Ab", "A", "A#/Bb", "B")
+PC_A = 9  # pitch class of A, which the reference pitch is given for
+
+SEMITONES_PER_LOG = 12 / math.log(2)
+
+# Offsets from equal temperament in cents for each pitch class, starting from the key note (C unless set otherwise)
+TEMPERAMENTS = {
+    "equal": (0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0),
+    "just": (0, 11.7, 3.9, 15.6, -13.7, -2.0, -9.8, 2.0, 13.7, -15.6, 17.6, -11.7),
+    "pythagorean": (0, 13.7, 3.9, -5.9, 7.8, -2.0, 11.7, 2.0, -7.8, 5.9, -3.9, 9.8),
+    "meantone": (0, -24.0, -6.8, 10.3, -13.7, 3.4, -20.5, -3.4, -27.4, -10.3, 6.8, -17.1),
+    "werckmeister3": (0, -9.8, -7.8, -5.9, -9.8, -2.0, -11.7, -3.9, -7.8, -11.7, -3.9, -7.8),
+}
+
+class NoteFinder:
+    def __init__(self, a4=440.0, temperament="equal", key=0):
+        self.set_reference(a4)
+        self.set_temperament(temperament, key)
+
+    def set_reference(self, a4):
+        self.a4 = a4
+        self._log_a4 = math.log(a4)
+
+    def set_temperament(self, name, key=0):
+        """
+        Use one of the TEMPERAMENTS, with its key note on pitch class key (0 = C).
+
+        The offsets are shifted so that A stays at the reference pitch.
+        """
+        table = TEMPERAMENTS[name]
+        ref = table[(PC_A - key) % 12]
+        self.temperament = name
+        self.offsets = tuple(table[(pc - key) % 12] - ref for pc in range(12))
+
+    def find(self, f):
+        """
+        Return the nearest note to frequency f.
+
+        :param f: frequency (hertz), must be > 0
+        :return: note name, octave (4 is the octave from middle C) and how far f is from the note in cents
+        :rtype: tuple
+        """
+        semitones = SEMITONES_PER_LOG * (math.log(f) - self._log_a4)
+        n = round(semitones)
+        cents = self._cents(semitones, n)
+
+        # a tempered note can be nearer than the equal tempered one we rounded to
+        if cents > 50:
+            n += 1
+            cents = self._cents(semitones, n)
+        elif cents < -50:
+            n -= 1
+            cents = self._cents(semitones, n)
+
+        pc = (n + PC_A) % 12
+        return NOTE_NAMES[pc], 4 + (n + PC_A) // 12, cents
+
+    def _cents(self, semitones, n):
+        return 100 * (semitones - n) - self.offsets[(n + PC_A) % 12]
+
+    def frequency(self, pc, octave):
+        """
+        Frequency of a note in the current reference and temperament.
+
+        :param pc: pitch class (0 = C)
+        :param octave: octave number, 4 is the octave from middle C
+        :rtype: float
+        """
+        n = pc - PC_A + 12 * (octave - 4)
+        return self.a4 * math.exp((n + self.offsets[pc] / 100) / SEMITONES_PER_LOG)
@@ -0,0 +1,100 @@
+"""
+Beat patterns for the metronome.
+
+Patterns live in a file with one JSON object per line, so new ones can be added without touching the code:
+
+    {"name": "Tangos", "beats": 4, "tempo_x": 1, "subbeats": 2, "sounds": "--00x-0-", "leds": ["222000000000", ...]}
+
+sounds has one character per step (beats * subbeats): x = strong, 0 = weak, anything else is silence.
+leds has one frame per beat, a colour index for each of the LED_COUNT LEDs on the ring (see Metronome.led_colors).
+
+Only the names and file offsets are kept for the whole library. A pattern is read and compiled into flat per-step
+tables when it's selected, so the metronome doesn't need any parsing or dict lookups while it's playing.
+"""
+
+import json
+
+SILENT = 0
+STRONG = 1
+WEAK = 2
+SOUND_CODES = {"x": STRONG, "0": WEAK}
+LED_COUNT = 12  # LEDs on the ring, one colour each in every frame
+
+class Pattern:
+    def __init__(self, spec, led_offset=0):
+        """
+        Compile a pattern from its file entry.
+
+        :param led_offset: index of the LED that the first colour in each frame goes to
+        """
+        self.name = spec["name"]
+        self.beats = spec["beats"]
+        self.subbeats = spec["subbeats"]
+        self.tempo_x = spec["tempo_x"]
+
+        sounds = spec["sounds"]
+        self.steps = len(sounds)
+        if self.steps != self.beats * self.subbeats:
+            raise ValueError(f"{self.name}: {self.steps} sounds for {self.beats} x {self.subbeats} steps")
+
+        # per step tables
+        self.sounds = bytes(SOUND_CODES.get(c, SILENT) for c in sounds)
+        self.on_beat = bytes(k % self.subbeats == 0 for k in range(self.steps))
+        self.beat = bytes(k // self.subbeats for k in range(self.steps))
+
+        frames = spec["leds"]
+        if len(frames) != self.beats:
+            raise ValueError(f"{self.name}: {len(frames)} LED frames for {self.beats} beats")
+        for frame in frames:
+            if len(frame) != LED_COUNT:
+                raise ValueError(f"{self.name}: LED frame {frame} isn't {LED_COUNT} colours")
+
+        # per beat LED frames, already rotated to where they go on the ring
+        self.leds = []
+        for frame in frames:
+            self.leds.append(bytes(int(frame[(i - led_offset) % LED_COUNT]) for i in range(LED_COUNT)))
+
+    def led_frames(self, pixels):
+        """
+        Render the LED frames into raw pixel data.
+
+        :param pixels: bytes for one pixel of each colour index, in the strip's byte order
+        :return: one buffer per beat, ready to send to the strip
+        :rtype: list
+        """
+        return [b"".join(pixels[c] for c in frame) for frame in self.leds]
+
+    def steps_per_minute(self, tempo):
+        return tempo * self.tempo_x * self.subbeats
+
+
+class PatternLibrary:
+    def __init__(self, path, led_offset=0):
+        self.path = path
+        self.led_offset = led_offset
+        self.names = []
+        self._offsets = []
+
+        # one pass through the file to find where each pattern starts
+        with open(path, "r") as f:
+            while True:
+                pos = f.tell()
+                line = f.readline()
+                if not line:
+                    break
+                if line.strip():
+                    self.names.append(json.loads(line)["name"])
+                    self._offsets.append(pos)
+
+    def __len__(self):
+        return len(self.names)
+
+    def load(self, index):
+        """
+        Read and compile one pattern.
+
+        :rtype: Pattern
+        """
+        with open(self.path, "r") as f:
+            f.seek(self._offsets[index])
+            return Pattern(json.loads(f.readline()), self.led_offset)
@@ -0,0 +1,272 @@
+"""
+Drift-free step scheduler for the metronome.
+
+Steps are due at absolute deadlines, base + n * 60000 / steps_per_minute ms, worked out in integer ticks from the
+step number instead of from when the last step actually fired. So however late the main loop gets round to a
+step, the next one is still due on the beat and the lateness never adds up into drift.
+
+JitterLog records how late each step actually fired, for reports on the serial console.
+
+This only needs adafruit_ticks, so it also runs on a computer (with adafruit_ticks and Blinka installed) using a
+FakeClock: `python scheduler.py` runs test_jitter_log() and test(). The second prints timing reports from
+simulate() and fails if the timing has got worse.
+"""
+
+import array
+import random
+from adafruit_ticks import ticks_ms, ticks_add, ticks_diff
+
+MS_PER_MINUTE = 60000
+
+class Scheduler:
+    def __init__(self, steps_per_minute=60, clock=ticks_ms):
+        self.clock = clock
+        self.rate = steps_per_minute
+        self.base = clock()
+        self.t_start = self.base
+        self.t_fired = self.base  # when the last step was picked up
+        self.n = 0          # steps fired since base
+        self.count = 0      # steps fired since start, including skipped ones
+        self.late = 0       # how late the last step was picked up (ms)
+
+    def start(self, delay_ms=0):
+        """
+        Start counting from now, the first step is due after delay_ms, straight away by default.
+        """
+        self.base = ticks_add(self.clock(), delay_ms)
+        self.t_start = self.base
+        self.n = 0
+        self.count = 0
+        self.late = 0
+
+    def deadline(self, n):
+        return ticks_add(self.base, n * MS_PER_MINUTE // self.rate)
+
+    def next_deadline(self):
+        return self.deadline(self.n)
+
+    def set_rate(self, steps_per_minute):
+        """
+        Change the tempo. The next step is due one new interval after the last one that fired,
+        so a change mid-bar takes effect from the next step without a jump.
+        """
+        if self.n > 0:
+            self.base = self.deadline(self.n - 1)
+            self.n = 1
+        self.rate = steps_per_minute
+
+    def poll(self):
+        """
+        Check for due steps.
+
+        If the loop was held up for more than a whole interval, the steps missed in between are skipped
+        rather than fired in a burst, and the pattern should still be advanced past them to stay in time.
+
+        :return: number of steps that came due since the last call, 0 if none
+        :rtype: int
+        """
+        now = self.clock()
+        elapsed = ticks_diff(now, self.base)
+        # deadlines 0..due-1 are at or before now
+        due = ((elapsed + 1) * self.rate + MS_PER_MINUTE - 1) // MS_PER_MINUTE
+        if due <= self.n:
+            return 0
+
+        steps = due - self.n
+        self.late = elapsed - (due - 1) * MS_PER_MINUTE // self.rate
+        self.n = due
+        self.count += steps
+        self.t_fired = now
+
+        # every rate steps is exactly one minute, so the base can move on without rounding
+        # and the tick differences stay small. n stays at least 1 so set_rate() can still find the last step.
+        if self.n > self.rate:
+            minutes = (self.n - 1) // self.rate
+            self.base = ticks_add(self.base, minutes * MS_PER_MINUTE)
+            self.n -= minutes * self.rate
+        return steps
+
+    def drift(self):
+        """
+        How far the deadline of the last step is from its ideal time counting from start() without any rounding,
+        in ms. Only meaningful if the rate hasn't changed since start().
+        """
+        if self.count == 0:
+            return 0
+        fired = ticks_diff(self.t_fired, self.t_start) - self.late
+        return fired - (self.count - 1) * MS_PER_MINUTE / self.rate
+
+
+class JitterLog:
+    """
+    How late the last size steps fired, in a ring buffer that's allocated once, so recording doesn't allocate.
+    """
+
+    def __init__(self, size=256):
+        self.late = array.array("l", [0] * size)
+        self.size = size
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.drift = 0
+
+    def record(self, late, drift=0):
+        """
+        Log one step.
+
+        :param late: how late it fired (ms)
+        :param drift: how far its deadline is from the ideal (ms)
+        """
+        self.late[self.count % self.size] = late
+        self.count += 1
+        self.drift = drift
+
+    def stats(self):
+        """
+        :return: steps in the log, mean and max lateness (ms) and the last drift (ms)
+        :rtype: tuple
+        """
+        n = min(self.count, self.size)
+        if n == 0:
+            return 0, 0, 0, 0
+        total = 0
+        worst = 0
+        for i in range(n):
+            total += self.late[i]
+            worst = max(worst, self.late[i])
+        return n, total / n, worst, self.drift
+
+    def report(self, name=""):
+        n, late_mean, late_max, drift = self.stats()
+        print(f"{name} timing over {n} of {self.count} steps: late mean {late_mean:.1f} ms max {late_max} ms, drift {drift:.2f} ms")
+
+
+class FakeClock:
+    """
+    Stand-in for ticks_ms, to run the scheduler on a computer.
+    """
+
+    def __init__(self, start=0):
+        self.ticks = start
+
+    def __call__(self):
+        return self.ticks
+
+    def advance(self, ms):
+        self.ticks = ticks_add(self.ticks, ms)
+
+
+def simulate(steps_per_minute=240, duration_ms=60000, loop_ms=10, work_ms=(0, 1, 3, 7, 25), seed=1,
+             change_ms=None, new_rate=None):
+    """
+    Run a Scheduler against a FakeClock and measure its timing.
+
+    Each pass of the simulated main loop takes loop_ms plus a work time picked from work_ms, like the 10 ms sleep
+    in main.py plus display updates. The clock starts just below the ticks wraparound to check that too.
+    If change_ms is given, the rate changes to new_rate at that time, usually part way between two steps.
+
+    Drift is measured against ideal step times kept separately in floats, counted in exact intervals from the
+    start, or after a tempo change from the step before it as it was scheduled, which is what the new rate follows on
+    from.
+
+    :return: steps fired, steps skipped, the JitterLog of the fired steps and the largest drift (ms) of any step
+    :rtype: tuple
+    """
+    random.seed(seed)
+    clock = FakeClock(start=(1 << 29) - 5000)
+    sched = Scheduler(steps_per_minute, clock=clock)
+    sched.start()
+    max_rate = max(steps_per_minute, new_rate or 0)
+    log = JitterLog(size=duration_ms * max_rate // MS_PER_MINUTE + 1)
+
+    elapsed = 0
+    skipped = 0
+    ideal = None  # ideal time of the last step fired
+    fired_at = 0  # deadline of the last step fired
+    drift_max = 0
+    rate = steps_per_minute
+    while elapsed < duration_ms:
+        if change_ms is not None and elapsed >= change_ms:
+            sched.set_rate(new_rate)
+            rate = new_rate
+            change_ms = None
+            if ideal is not None:
+                ideal = fired_at
+
+        steps = sched.poll()
+        if steps:
+            skipped += steps - 1
+            ideal = (steps - 1) * MS_PER_MINUTE / rate if ideal is None else ideal + steps * MS_PER_MINUTE / rate
+            fired_at = elapsed - sched.late  # the deadline it fired for
+            drift = fired_at - ideal
+            drift_max = max(drift_max, abs(drift))
+            log.record(sched.late, drift)
+
+        step = loop_ms + random.choice(work_ms)
+        clock.advance(step)
+        elapsed += step
+
+    return log.count, skipped, log, drift_max
+
+
+def test_jitter_log():
+    """
+    Check JitterLog's statistics on known lateness values, before and after the ring wraps.
+    """
+    log = JitterLog()
+    assert log.stats() == (0, 0, 0, 0)
+
+    for late in (3, 9, 0, 4):
+        log.record(late, drift=0.5)
+    assert log.stats() == (4, 4.0, 9, 0.5), log.stats()
+
+    # 300 steps into a 256 entry ring: only the last 256 (late = 44..299) are kept, the 9 above is gone
+    log.reset()
+    for late in range(300):
+        log.record(late, drift=-0.25)
+    n, late_mean, late_max, drift = log.stats()
+    assert log.count == 300
+    assert n == 256
+    assert late_mean == sum(range(44, 300)) / 256, late_mean
+    assert late_max == 299
+    assert drift == -0.25
+
+    # the oldest entries are overwritten, a new small value doesn't bring back an old large one
+    log.reset()
+    log.record(1000)
+    for _ in range(log.size):
+        log.record(2)
+    assert log.stats()[:3] == (256, 2.0, 2), log.stats()
+    print("JitterLog OK")
+
+
+def test():
+    """
+    Check the scheduler's timing under FakeClock, raises AssertionError if it has got worse.
+
+    Steps are only ever late by up to one pass of the loop, and the deadlines mustn't drift from the ideal times,
+    including across a tempo change in the middle of a step.
+    """
+    loop_ms = 10
+    work_ms = (0, 1, 3, 7, 25)
+    longest_pass = loop_ms + max(work_ms)
+    cases = [(spm, None, None) for spm in (60, 240, 260, 800)]
+    cases += [(240, 10110, 300), (260, 20003, 130), (800, 30007, 60)]
+    # just after the last step of a minute, 59750 ms, when the scheduler moves its base on
+    cases += [(240, 59800, 60)]
+    for spm, change_ms, new_rate in cases:
+        fired, skipped, log, drift_max = simulate(spm, duration_ms=90000, loop_ms=loop_ms, work_ms=work_ms,
+                                                  change_ms=change_ms, new_rate=new_rate)
+        name = f"{spm} steps/min" + (f" changing to {new_rate} at {change_ms} ms" if change_ms else "")
+        n, late_mean, late_max, drift = log.stats()
+        log.report(f"{name}, {skipped} skipped,")
+        assert fired > 0, name
+        assert 0 <= late_max <= longest_pass, f"{name}: late by {late_max} ms"
+        assert drift_max < 1, f"{name}: drifted {drift_max} ms"
+    print("Scheduler timing OK")
+
+
+if __name__ == "__main__":
+    test_jitter_log()
+    test()
@@ -1,17 +1,40 @@
 """
 Implementation of YIN algorithm for CircuitPython, adapted from https://github.com/patriceguyot/Yin/blob/master/yin.py
 
-I was unable to adapt the fastest version of the difference function.
-- The complex arrays and conjugate function appear to have been removed from CircuitPython.
-- CircuitPython's fft and ifft functions do not use complex arrays.
-
-However I was able to adapt the "scipy" version of the difference function, as the convolve function was actually in the firmware although it wasn't in the documentation.
+The complex arrays and conjugate function appear to have been removed from CircuitPython, and its fft and ifft
+functions take and return separate real and imaginary arrays instead. difference_function_fft works with that to get
+the O(n log n) autocorrelation. The "scipy" version using convolve is kept as difference_function, as the convolve
+function was actually in the firmware although it wasn't in the documentation.
 
 Functions have been renamed to keep my linter happy.
+
+For the tuner loop, YinPlan holds preallocated buffers so a frame can be analysed without building new arrays each time,
+and YinTracker runs it on a sliding window over a stream of sample blocks.
 """
 
+import math
 import ulab.numpy as np
-from adafruit_itertools import accumulate
+
+def cumsum(a, out=None):
+    """
+    Cumulative sum of a 1D array.
+
+    ulab has no cumsum, so this is a log-step scan: log2(n) vectorised adds instead of a Python loop over every element.
+
+    :param a: input array
+    :param out: optional preallocated float array (or view) of the same length to write into
+    :return: running sum of a
+    :rtype: ndarray
+    """
+    if out is None:
+        out = np.zeros(len(a))
+    out[:] = a
+    n = len(out)
+    shift = 1
+    while shift < n:
+        out[shift:] = out[shift:] + out[:n - shift]
+        shift <<= 1
+    return out
 
 def difference_function_original(x, n, tau_max):
     """
@@ -49,9 +72,8 @@ def difference_function(x, n, tau_max):
     """
     x = np.array(x)
     w = x.size
-    x_cumsum = np.concatenate((np.array([0]), np.array(list(accumulate(x * x)))))
+    x_cumsum = np.concatenate((np.zeros(1), cumsum(x * x)))
     conv = np.convolve(x, x[::-1])
-    #x_cumsum = np.concatenate((np.array([0]), (x * x).cumsum()))
     #conv = fftconvolve(x, x[::-1])
     tmp = x_cumsum[w:0:-1] + x_cumsum[w] - x_cumsum[:w] - 2 * conv[w - 1:]
     # for some reason the original code produces one more element
@@ -59,6 +81,38 @@ def difference_function(x, n, tau_max):
     return tmp[:tau_max]
 
 
+def _next_pow2(n):
+    size = 1
+    while size < n:
+        size <<= 1
+    return size
+
+def difference_function_fft(x, n, tau_max):
+    """
+    Compute difference function of data x. This corresponds to equation (6) in [1]
+
+    Same result as difference_function, but the autocorrelation is taken from the power spectrum (Wiener–Khinchin)
+    instead of np.convolve, so this is O(n log n) rather than O(n^2).
+    ulab's fft needs a power of two length, so the frame is zero-padded to at least w + tau_max samples.
+    That keeps the circular correlation from wrapping around into the lags we actually use.
+
+    :param x: audio data
+    :param N: length of data
+    :param tau_max: integration window size
+    :return: difference function
+    :rtype: list
+    """
+    x = np.array(x)
+    w = x.size
+    tau_max = min(tau_max, w)
+    padded = np.zeros(_next_pow2(w + tau_max))
+    padded[:w] = x
+    re, im = np.fft.fft(padded)
+    acf, _ = np.fft.ifft(re * re + im * im)
+    x_cumsum = np.concatenate((np.zeros(1), cumsum(x * x)))
+    return x_cumsum[w:w - tau_max:-1] + x_cumsum[w] - x_cumsum[:tau_max] - 2 * acf[:tau_max]
+
+
 def cumulative_mean_normalized_difference_function(df, n):
     """
     Compute cumulative mean normalized difference function (CMNDF).
@@ -71,7 +125,7 @@ def cumulative_mean_normalized_difference_function(df, n):
     :rtype: list
     """
 
-    cmndf =  df[1:] * np.array(range(1, n)) / np.array(list(accumulate(df[1:])))
+    cmndf =  df[1:] * np.arange(1, n, dtype=np.float) / cumsum(df[1:])
     #cmndf = df[1:] * range(1, N) / np.cumsum(df[1:]).astype(float) #scipy method
     return np.concatenate((np.ones(1), cmndf))
 
@@ -96,7 +150,42 @@ def get_pitch(cmdf, tau_min, tau_max, harmo_th=0.1):
 
     return 0    # if unvoiced
 
-def compute_yin(sig, sr, w_len=512, w_step=256, f0_min=100, f0_max=500, harmo_thresh=0.1):
+def parabolic_interpolation(cmdf, tau):
+    """
+    Refine a period to a fraction of a sample by fitting a parabola through the CMNDF at tau - 1, tau and tau + 1.
+
+    This is the parabolic interpolation step of [1]. Without it the period is only known to the nearest sample,
+    which at 8 kHz is about +/-20 cents for A4.
+
+    :param cmdf: Cumulative Mean Normalized Difference function
+    :param tau: period (int) at a local minimum of cmdf, e.g. from get_pitch
+    :return: fractional period
+    :rtype: float
+    """
+    if tau < 1 or tau + 1 >= len(cmdf):
+        return float(tau)
+    a = cmdf[tau - 1]
+    b = cmdf[tau]
+    c = cmdf[tau + 1]
+    denom = a - 2 * b + c
+    if denom <= 0:
+        return float(tau)
+    return tau + 0.5 * (a - c) / denom
+
+CENTS_PER_LOG = 1200 / math.log(2)
+
+def cents(f, f_ref):
+    """
+    Difference between two frequencies in cents (100 cents = 1 semitone).
+
+    :param f: frequency (hertz)
+    :param f_ref: reference frequency (hertz)
+    :return: cents above f_ref, negative if below
+    :rtype: float
+    """
+    return CENTS_PER_LOG * math.log(f / f_ref)
+
+def compute_yin(sig, sr, w_len=512, w_step=256, f0_min=100, f0_max=500, harmo_thresh=0.1, use_fft=False):
     """
     Compute the Yin Algorithm. Return fundamental frequency and harmonic rate.
 
@@ -107,6 +196,7 @@ def compute_yin(sig, sr, w_len=512, w_step=256, f0_min=100, f0_max=500, harmo_th
     :param f0_min: Minimum fundamental frequency that can be detected (hertz)
     :param f0_max: Maximum fundamental frequency that can be detected (hertz)
     :param harmo_tresh: Threshold of detection. The yalgorithmù return the first minimum of the CMND fubction below this treshold.
+    :param use_fft: use difference_function_fft instead of the convolve version
 
     :returns:
 
@@ -129,10 +219,12 @@ def compute_yin(sig, sr, w_len=512, w_step=256, f0_min=100, f0_max=500, harmo_th
     harmonic_rates = [0.0] * len(time_scale)
     argmins = [0.0] * len(time_scale)
 
+    diff_func = difference_function_fft if use_fft else difference_function
+
     for i, frame in enumerate(frames):
 
         # Compute YIN
-        df = difference_function(frame, w_len, tau_max)
+        df = diff_func(frame, w_len, tau_max)
         cmdf = cumulative_mean_normalized_difference_function(df, tau_max)
         p = get_pitch(cmdf, tau_min, tau_max, harmo_thresh)
 
@@ -146,3 +238,310 @@ def compute_yin(sig, sr, w_len=512, w_step=256, f0_min=100, f0_max=500, harmo_th
             harmonic_rates[i] = min(cmdf)
 
     return pitches, harmonic_rates, argmins, times
+
+
+def compute_yin_with_plan(sig, plan, w_step=256):
+    """
+    Same as compute_yin, but reuses the buffers of a YinPlan instead of allocating new ones for every frame.
+
+    :param sig: Audio signal (ndarray)
+    :param plan: YinPlan built for the sampling rate, window size and pitch range to use
+    :param w_step: size of the lag between two consecutives windows (samples)
+    :returns: pitches, harmonic_rates, argmins, times as in compute_yin
+    :rtype: tuple
+    """
+    time_scale = range(0, len(sig) - plan.w_len, w_step)
+    times = [t/float(plan.sr) for t in time_scale]
+
+    pitches = [0.0] * len(time_scale)
+    harmonic_rates = [0.0] * len(time_scale)
+    argmins = [0.0] * len(time_scale)
+
+    for i, t in enumerate(time_scale):
+        pitches[i], harmonic_rates[i], argmins[i] = plan.compute(sig[t:t + plan.w_len])
+
+    return pitches, harmonic_rates, argmins, times
+
+
+class YinPlan:
+    """
+    Preallocated buffers for running YIN on frames of one fixed configuration.
+
+    Make one per (w_len, tau_min, tau_max) and reuse it for every frame. The FFT padding, energy terms,
+    difference function, CMNDF and the 1..tau_max ramp are all kept here instead of being rebuilt per call.
+
+    Once a pitch has been found, track() can follow it by computing only the lags near the last period.
+    Periods are refined with parabolic_interpolation unless interpolate is False.
+    """
+
+    # half width of the lag window searched by track(), as a fraction of the period (about a semitone)
+    TRACK_SPAN = 0.06
+
+    def __init__(self, sr, w_len=512, f0_min=100, f0_max=500, harmo_thresh=0.1, interpolate=True):
+        self.sr = sr
+        self.w_len = w_len
+        self.tau_min = int(sr / f0_max)
+        self.tau_max = min(int(sr / f0_min), w_len)
+        self.harmo_thresh = harmo_thresh
+        self.interpolate = interpolate
+
+        self.padded = np.zeros(_next_pow2(w_len + self.tau_max))
+        self.x_cumsum = np.zeros(w_len + 1)
+        self.ramp = np.arange(1, self.tau_max, dtype=np.float)
+        self.df = np.zeros(self.tau_max)
+        self.df_cumsum = np.zeros(self.tau_max - 1)
+        self.cmdf = np.ones(self.tau_max)
+
+        # state of the last full search, used by track()
+        self.tau = 0
+        self.energy_ref = 0.0
+
+    def load(self, x):
+        """
+        Copy frame x into the FFT buffer and sum its energy terms.
+
+        Not needed when the frame is already in self.padded[:w_len] with self.x_cumsum up to date,
+        which is how YinTracker feeds it.
+        """
+        frame = self.padded[:self.w_len]
+        frame[:] = x
+        cumsum(frame * frame, self.x_cumsum[1:])
+
+    def difference(self, x=None):
+        """
+        Difference function of frame x (or the loaded frame if None) into self.df, same as difference_function_fft.
+        """
+        w = self.w_len
+        tau_max = self.tau_max
+        if x is not None:
+            self.load(x)
+        re, im = np.fft.fft(self.padded)
+        acf, _ = np.fft.ifft(re * re + im * im)
+
+        df = self.df
+        df[:] = self.x_cumsum[w:w - tau_max:-1]
+        df += self.x_cumsum[w]
+        df -= self.x_cumsum[:tau_max]
+        df -= 2 * acf[:tau_max]
+        return df
+
+    def cumulative_mean(self, df):
+        """
+        CMNDF of df into self.cmdf, same as cumulative_mean_normalized_difference_function.
+        """
+        cumsum(df[1:], self.df_cumsum)
+        self.cmdf[1:] = df[1:] * self.ramp / self.df_cumsum
+        return self.cmdf
+
+    def compute(self, x=None):
+        """
+        Run YIN on a single frame of w_len samples.
+
+        :param x: audio frame (ndarray), or None if already loaded (see load)
+        :returns: pitch (0.0 if unvoiced), harmonic rate and argmin pitch of the frame
+        :rtype: tuple
+        """
+        cmdf = self.cumulative_mean(self.difference(x))
+        p = get_pitch(cmdf, self.tau_min, self.tau_max, self.harmo_thresh)
+        self.tau = p
+        self.energy_ref = self.x_cumsum[self.w_len]
+
+        argmin = np.argmin(cmdf)
+        argmin_pitch = float(self.sr / argmin) if argmin > self.tau_min else 0.0
+        if p != 0: # A pitch was found
+            return self._pitch(p), cmdf[p], argmin_pitch
+        # No pitch, but we compute a value of the harmonic rate
+        return 0.0, np.min(cmdf), argmin_pitch
+
+    def track(self, x=None):
+        """
+        Re-estimate the pitch assuming it is still close to the period found last time.
+
+        Only the lags within TRACK_SPAN of self.tau are computed, with direct dot products instead of the FFT.
+        The cumulative mean below that window is taken from the last full search, scaled by the change in frame
+        energy. The CMNDF values land in self.cmdf at their own lags.
+
+        :param x: audio frame (ndarray), or None if already loaded (see load)
+        :returns: pitch, harmonic rate and pitch at the minimum as in compute,
+            or None if the minimum is not confidently inside the window and a full search is needed
+        :rtype: tuple
+        """
+        if x is not None:
+            self.load(x)
+        tau = self.tau
+        if tau == 0 or self.energy_ref <= 0:
+            return None
+
+        w = self.w_len
+        frame = self.padded[:w]
+        cs = self.x_cumsum
+        energy = cs[w]
+        span = max(2, int(tau * self.TRACK_SPAN))
+        lo = max(self.tau_min, tau - span, 2)
+        hi = min(self.tau_max - 1, tau + span)
+
+        running = self.df_cumsum[lo - 2] * energy / self.energy_ref
+        best = 0
+        for t in range(lo, hi + 1):
+            d = cs[w - t] + energy - cs[t] - 2 * np.dot(frame[:w - t], frame[t:])
+            running += d
+            self.cmdf[t] = d * t / running if running > 0 else 1.0
+            if best == 0 or self.cmdf[t] < self.cmdf[best]:
+                best = t
+
+        if best == lo or best == hi or self.cmdf[best] >= self.harmo_thresh:
+            return None
+
+        self.tau = best
+        pitch = self._pitch(best)
+        return pitch, self.cmdf[best], pitch
+
+    def _pitch(self, tau):
+        if self.interpolate:
+            return self.sr / parabolic_interpolation(self.cmdf, tau)
+        return float(self.sr / tau)
+
+
+class YinTracker:
+    """
+    Streaming YIN over overlapping windows.
+
+    Push blocks of new samples as they are captured and a pitch estimate is made every hop samples, on the latest
+    w_len samples. The window lives in the plan's FFT buffer and is shifted along in place rather than sliced
+    out of a signal, and the energy terms (x_cumsum) are shifted with it, so each hop only sums the energy of
+    the new samples. A full recount is done every RESYNC_HOPS hops so float rounding can't build up.
+
+    The blocks have to follow on from each other with no samples missing in between. If the input has a gap, call
+    reset(): no estimates are made until w_len new samples have filled the window again.
+    """
+
+    RESYNC_HOPS = 64
+
+    def __init__(self, plan, hop=128, tracking=False):
+        self.plan = plan
+        self.hop = hop
+        self.tracking = tracking  # follow the last pitch with YinPlan.track while it holds
+        self.window = plan.padded[:plan.w_len]
+        self.pending = 0  # samples received since the last estimate
+        self.filled = 0   # samples received since reset, up to w_len
+        self.hops = 0
+
+        self.pitch = 0.0
+        self.harmonic_rate = 1.0
+        self.argmin = 0.0
+
+    def reset(self):
+        """
+        Drop the window, for when the next block doesn't follow on from the last one.
+        """
+        self.window[:] = 0
+        self.plan.x_cumsum[:] = 0
+        self.plan.tau = 0
+        self.pending = 0
+        self.filled = 0
+        self.pitch = 0.0
+        self.harmonic_rate = 1.0
+
+    def _shift_in(self, block):
+        w = self.plan.w_len
+        k = len(block)
+        win = self.window
+        cs = self.plan.x_cumsum
+        if k >= w:
+            win[:] = block[k - w:]
+            cumsum(win * win, cs[1:])
+            return
+
+        win[:w - k] = win[k:]
+        win[w - k:] = block
+        cs[:w - k + 1] = cs[k:] - cs[k]
+        tail = win[w - k:]
+        cumsum(tail * tail, cs[w - k + 1:])
+        cs[w - k + 1:] += cs[w - k]
+
+    def push(self, block, analyse=True):
+        """
+        Add a block of new samples.
+
+        :param block: new audio samples (ndarray). int16 blocks are fine, e.g. from hardware.mic_to_int16:
+            they are converted to float as they are copied into the window, and the squares are taken from there.
+        :param analyse: False to only keep the window up to date, e.g. while a NoiseGate is closed.
+            The result is then reported as unvoiced and tracking starts over with a full search.
+        :return: True if a new estimate was made, available in pitch, harmonic_rate and argmin
+        :rtype: bool
+        """
+        self._shift_in(block)
+        self.pending += len(block)
+        self.filled = min(self.filled + len(block), self.plan.w_len)
+        if self.filled < self.plan.w_len:
+            # still refilling after a reset, the window would join unrelated audio
+            return False
+        if not analyse:
+            self.pitch = 0.0
+            self.harmonic_rate = 1.0
+            self.plan.tau = 0
+            return False
+        if self.pending < self.hop:
+            return False
+
+        self.pending = 0
+        self.hops += 1
+        if self.hops % self.RESYNC_HOPS == 0:
+            cumsum(self.window * self.window, self.plan.x_cumsum[1:])
+
+        result = self.plan.track() if self.tracking else None
+        if result is None:
+            result = self.plan.compute()
+        self.pitch, self.harmonic_rate, self.argmin = result
+        return True
+
+
+class NoiseGate:
+    """
+    Decides whether a block of samples is loud enough to be worth running YIN on.
+
+    The level is the RMS of the block with its mean removed, in whatever units the samples are in.
+    The gate opens above threshold and only closes again below threshold * hysteresis, so a note that is dying
+    away doesn't flicker in and out. calibrate() sets the threshold from blocks of ambient noise instead.
+    """
+
+    def __init__(self, threshold=24.0, hysteresis=0.7, margin=2.0):
+        self.threshold = threshold
+        self.hysteresis = hysteresis
+        self.margin = margin  # threshold = ambient noise level * margin after calibration
+        self.is_open = False
+        self.level = 0.0
+
+        self._cal_sum = 0.0
+        self._cal_count = 0
+
+    def update(self, block):
+        """
+        Measure a block and update the gate.
+
+        :param block: audio samples (ndarray)
+        :return: True if the gate is open
+        :rtype: bool
+        """
+        self.level = np.std(block)
+        if self.is_open:
+            self.is_open = self.level >= self.threshold * self.hysteresis
+        else:
+            self.is_open = self.level >= self.threshold
+        return self.is_open
+
+    def start_calibration(self):
+        self._cal_sum = 0.0
+        self._cal_count = 0
+
+    def calibrate(self, block):
+        """
+        Add a block of ambient noise to the calibration. The threshold follows the average level so far.
+
+        :param block: audio samples (ndarray) recorded with nothing playing
+        """
+        self.level = np.std(block)
+        self._cal_sum += self.level
+        self._cal_count += 1
+        self.threshold = self.margin * self._cal_sum / self._cal_count
+        self.is_open = False